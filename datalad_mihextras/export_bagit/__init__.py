@@ -0,0 +1,493 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Export a dataset to a Bag-it
+
+https://www.rfc-editor.org/rfc/rfc8493.html
+"""
+
+__docformat__ = 'restructuredtext'
+
+
+import logging
+import shlex
+
+from datalad.interface.common_opts import (
+    jobs_opt,
+    recursion_limit,
+    recursion_flag,
+)
+from datalad.utils import (
+    ensure_list,
+)
+
+from datalad_next.commands import (
+    EnsureCommandParameterization,
+    ValidatedInterface,
+    Parameter,
+    build_doc,
+    datasetmethod,
+    eval_results,
+    get_status_dict,
+)
+from datalad_next.constraints import (
+    EnsureChoice,
+    EnsureInt,
+    EnsureListOf,
+    EnsureNone,
+    EnsurePath,
+    EnsureStr,
+)
+# TODO migrate to block above with datalad-next >v1.2
+from datalad_next.constraints.dataset import (
+    EnsureDataset,
+)
+from datalad_next.datasets import (
+    resolve_path,
+)
+
+from ._directory import (
+    _export_bags,
+)
+from ._git import (
+    _iter_datasets,
+)
+from ._payload import (
+    _plan_export,
+)
+from ._stream import (
+    _stream_bag,
+)
+
+
+lgr = logging.getLogger('datalad.mihextras.export_bagit')
+
+archive_format_choices = ('tar', 'tgz', 'bz2', 'zip')
+link_mode_choices = ('copy', 'hardlink', 'reflink', 'auto')
+
+
+@build_doc
+class ExportBagit(ValidatedInterface):
+    """Export a dataset to a Bag-it
+
+    This is a proof-of-principle implementation that can export a DataLad
+    dataset into a BagIt bag, a standardized storage and and transfer
+    format for arbitrary digital content.
+
+    TODOs:
+
+    - Support for bag metadata specification
+
+    .. seealso::
+
+       `RFC8493 <https://www.rfc-editor.org/rfc/rfc8493.html>`_
+          BagIt specification.
+    """
+    _examples_ = [
+        dict(text="Export dataset to a bag directory at /tmp/bag",
+             code_py="x_export_bagit('/tmp/bag')",
+             code_cmd="datalad x-export-bagit /tmp/bag"),
+        dict(text="Export dataset to a ZIP archive bag at /tmp/bag.zip",
+             code_py="x_export_bagit('/tmp/bag', archive='zip')",
+             code_cmd="datalad x-export-bagit --archive zip /tmp/bag"),
+        dict(text="Stream a dataset as a gzip-compressed TAR archive bag "
+                  "to stdout, without creating a bag directory",
+             code_cmd="datalad x-export-bagit --archive tgz - > bag.tgz"),
+        dict(text="Update a previous export at /tmp/bag with all changes "
+                  "made to the dataset since",
+             code_py="x_export_bagit('/tmp/bag', update=True)",
+             code_cmd="datalad x-export-bagit --update /tmp/bag"),
+        dict(text="Export a dataset and all its subdatasets to a bag at "
+                  "/tmp/bag, with each subdataset in a bag of its own, "
+                  "building up to four bags concurrently",
+             code_py="x_export_bagit('/tmp/bag', recursive=True, "
+                     "bag_of_bags=True, dataset_jobs=4)",
+             code_cmd="datalad x-export-bagit -r --bag-of-bags "
+                      "--dataset-jobs 4 /tmp/bag"),
+        dict(text="Export the dataset state at tag v1.0 to /tmp/bag-v1.0",
+             code_py="x_export_bagit('/tmp/bag-v1.0', revision='v1.0')",
+             code_cmd="datalad x-export-bagit --revision v1.0 /tmp/bag-v1.0"),
+        dict(text="Export the dataset states at tags v1.0 and v2.0 to bags "
+                  "in /tmp/bags/v1.0 and /tmp/bags/v2.0, sharing files "
+                  "with identical content",
+             code_py="x_export_bagit('/tmp/bags', revision=['v1.0', 'v2.0'])",
+             code_cmd="datalad x-export-bagit --revision v1.0 "
+                      "--revision v2.0 /tmp/bags"),
+        dict(text="Report how much content an export to /tmp/bag would "
+                  "place into the bag, and whether there is enough space "
+                  "for it, without exporting anything",
+             code_py="x_export_bagit('/tmp/bag', plan=True)",
+             code_cmd="datalad x-export-bagit --plan /tmp/bag"),
+        dict(text="Export only the CSV files larger than 1MB in the "
+                  "directory 'results' of a dataset to /tmp/bag",
+             code_py="x_export_bagit('/tmp/bag', path='results', "
+                     "annex_match='--include=*.csv --largerthan=1MB')",
+             code_cmd="datalad x-export-bagit "
+                      "--annex-match='--include=*.csv --largerthan=1MB' "
+                      "/tmp/bag results"),
+    ]
+
+    _params_ = dict(
+        dataset=Parameter(
+            args=("-d", "--dataset"),
+            doc="""specify the dataset to export"""),
+        to=Parameter(
+            args=("to",),
+            metavar='PATH',
+            doc="""location to export to.
+            With [CMD: --archive CMD][PY: `archive` PY] this is the base path,
+            and a filename extension will be appended to it. With '-', the
+            bag is streamed to stdout as an archive (TAR, unless another
+            format is specified).""",
+            constraints=EnsureStr() | EnsureNone()),
+        path=Parameter(
+            args=("path",),
+            metavar='SUBPATH',
+            nargs='*',
+            doc="""only export files at or under these paths. Subdatasets
+            are only exported (with [CMD: --recursive CMD][PY: `recursive`
+            PY]) if they contain any of these paths, or are located
+            underneath one."""),
+        annex_match=Parameter(
+            args=("--annex-match",),
+            metavar='EXPR',
+            doc="""git-annex matching options, like '--include=*.csv
+            --largerthan=1MB', to only export annex'ed files matching them.
+            Files tracked in Git are never matched, and not exported
+            then."""),
+        archive=Parameter(
+            args=("--archive", ),
+            doc="""export bag as a single-file archive in the given format""",
+            choices=archive_format_choices),
+        recursive=recursion_flag,
+        recursion_limit=recursion_limit,
+        jobs=Parameter(
+            args=("-J", "--jobs"),
+            metavar="NJOBS",
+            doc="""number of payload files to copy into the bag in parallel,
+            and number of processes to hash payload files that could not be
+            hashed while copying. Largest files are copied first. "auto"
+            corresponds to the number defined by the
+            'datalad.runtime.max-jobs' configuration item""",
+            constraints=jobs_opt.constraints),
+        link_mode=Parameter(
+            args=("--link-mode",),
+            doc="""how to place local file content into the bag.
+            'copy' creates an independent copy of each file. 'hardlink'
+            hardlinks annex'ed files to their object in the dataset's annex
+            (files tracked in Git are still copied). 'reflink' creates a
+            copy-on-write clone of a file's content, if supported by the
+            filesystem. 'auto' tries reflinking, then hardlinking, before
+            copying. Whenever a link cannot be created, for example because
+            the bag is on a different filesystem, content is copied. The
+            default is 'copy', or 'auto' with an
+            [CMD: --object-store CMD][PY: `object_store` PY]""",
+            choices=link_mode_choices),
+        update=Parameter(
+            args=("--update",),
+            action='store_true',
+            doc="""update an existing bag at the target location. The commit
+            that was exported for each dataset is recorded in the bag's
+            bag-info.txt. Only files that changed between this commit and
+            the present dataset state are added, replaced or removed, and
+            the bag's manifests are amended accordingly. If no bag exists
+            yet, a new one is created."""),
+        stream=Parameter(
+            args=("--stream",),
+            action='store_true',
+            doc="""write the bag directly into an archive in the format
+            given by [CMD: --archive CMD][PY: `archive` PY], without creating
+            a bag directory first. All digests are computed while the
+            content is written to the archive."""),
+        revision=Parameter(
+            args=("--revision",),
+            metavar='COMMIT-ISH',
+            action='append',
+            doc="""export the dataset state at this commit-ish, instead of
+            the checked-out state. Content is read from Git's object store
+            and the dataset's annex, hence the worktree is not consulted
+            and need not be clean. Subdatasets are exported in the state
+            recorded in their superdataset. If given more than once, a bag
+            is built for each commit-ish, in a directory named after it
+            underneath the export location. Files with content that is
+            already in the bag of another version are hardlinked from
+            there, and their digests are reused."""),
+        dataset_jobs=Parameter(
+            args=("--dataset-jobs",),
+            metavar='NJOBS',
+            doc="""number of datasets to export concurrently, when exporting
+            recursively. Each dataset uses up to
+            [CMD: --jobs CMD][PY: `jobs` PY] threads to place its files into
+            the bag. Has no effect when streaming a bag into an
+            archive."""),
+        bag_of_bags=Parameter(
+            args=("--bag-of-bags",),
+            action='store_true',
+            doc="""export each subdataset into a bag of its own, instead of
+            placing its files into the bag of the superdataset. Such a bag
+            is written as an archive (in the format given by
+            [CMD: --archive CMD][PY: `archive` PY], or ZIP) into the
+            payload of the bag of the superdataset, at the location of the
+            subdataset. With [CMD: --update CMD][PY: `update` PY], the
+            bag of a subdataset is only rebuilt if the subdataset changed
+            since the last export. See
+            [CMD: --dataset-jobs CMD][PY: `dataset_jobs` PY] for building
+            bags concurrently."""),
+        get_missing=Parameter(
+            args=("--get-missing",),
+            action='store_true',
+            doc="""obtain any annex'ed file content that is not available
+            locally, but needs to be placed into the bag. Content is
+            obtained with up to [CMD: --jobs CMD][PY: `jobs` PY] parallel
+            downloads, while present content is already placed into the
+            bag. Without this option, such files are reported and left out
+            of the bag. Has no effect when streaming a bag into an
+            archive."""),
+        drop_fetched=Parameter(
+            args=("--drop-fetched",),
+            action='store_true',
+            doc="""drop content obtained with
+            [CMD: --get-missing CMD][PY: `get_missing` PY] again, once it
+            was placed into the bag."""),
+        file_urls=Parameter(
+            args=("--file-urls",),
+            action='store_true',
+            doc="""register annex'ed files whose content is available in a
+            local directory special remote with a file:// URL pointing into
+            that remote in the bag's fetch.txt, instead of placing the
+            content into the bag. URLs from the web have precedence. The
+            resulting bag is only complete on a system with access to the
+            special remote's directory."""),
+        remote_only=Parameter(
+            args=("--remote-only",),
+            action='store_true',
+            doc="""register all annex'ed files as remote files in the bag's
+            fetch.txt, and only place files tracked in Git into the bag.
+            Manifests use the size and digest of the annex keys, such that
+            no annex'ed content is read. The export of a dataset fails as
+            soon as an annex'ed file without a URL (and a key with size
+            and a supported digest) is encountered. See
+            [CMD: --file-urls CMD][PY: `file_urls` PY] for also using the
+            locations in directory special remotes as URLs."""),
+        plan=Parameter(
+            args=("--plan", "--dry-run"),
+            action='store_true',
+            doc="""do not export anything, but report for each dataset the
+            number and size of files that would be placed into the bag,
+            registered as remote files, or are left out for lack of
+            available content, followed by the predicted Payload-Oxum of
+            the bag. The export is reported as impossible, if the free
+            space at the target location is less than the size of all
+            files to be placed into the bag. No payload content is read.
+            The plan is for a complete export, also with
+            [CMD: --update CMD][PY: `update` PY]."""),
+        resume=Parameter(
+            args=("--resume",),
+            action='store_true',
+            doc="""continue an interrupted export. While a bag is built,
+            each payload file placed into it is recorded with its size,
+            modification time, and digests in a journal tag file, which is
+            removed once the bag is complete. With this option, recorded
+            files that are unchanged in the bag are not copied or hashed
+            again. Has no effect when streaming a bag into an
+            archive."""),
+        object_store=Parameter(
+            args=("--object-store",),
+            metavar='PATH',
+            doc="""directory of a local store of annex key content, shared
+            by any number of exports. The content of an annex'ed file is
+            copied (or reflinked) into the store once, and placed into
+            the bag from there according to
+            [CMD: --link-mode CMD][PY: `link_mode` PY]. By default, it is
+            reflinked or hardlinked where possible, such that no content
+            is written twice, and exports of content that is in the store
+            already cost no copies at all. Store content is read-only, and
+            so are bag files hardlinked to it. Content that is in the store
+            is not obtained with
+            [CMD: --get-missing CMD][PY: `get_missing` PY]. Has no effect
+            when streaming a bag into an archive."""),
+        object_store_size=Parameter(
+            args=("--object-store-size",),
+            metavar='BYTES',
+            doc="""size limit of the
+            [CMD: --object-store CMD][PY: `object_store` PY]. After an
+            export, the least recently used content is removed from the
+            store until its total size is within this limit. No content
+            is removed without a limit."""),
+    )
+
+    _validator_ = EnsureCommandParameterization(
+        param_constraints=dict(
+            archive=EnsureChoice(*archive_format_choices),
+            dataset=EnsureDataset(installed=True),
+            jobs=EnsureInt() | EnsureChoice('auto') | EnsureNone(),
+            link_mode=EnsureChoice(*link_mode_choices) | EnsureNone(),
+            revision=EnsureStr() | EnsureListOf(EnsureStr()) | EnsureNone(),
+            dataset_jobs=EnsureInt(),
+            to=EnsurePath(),
+            path=EnsurePath() | EnsureListOf(EnsurePath()) | EnsureNone(),
+            object_store=EnsurePath() | EnsureNone(),
+            object_store_size=EnsureInt() | EnsureNone(),
+            annex_match=EnsureStr() | EnsureNone(),
+        ),
+        validate_defaults=('dataset',),
+    )
+
+    @staticmethod
+    @datasetmethod(name='x_export_bagit')
+    @eval_results
+    def __call__(
+            to,
+            archive=None,
+            dataset=None,
+            recursive=False,
+            recursion_limit=None,
+            jobs='auto',
+            link_mode=None,
+            update=False,
+            stream=False,
+            revision=None,
+            dataset_jobs=1,
+            bag_of_bags=False,
+            get_missing=False,
+            drop_fetched=False,
+            file_urls=False,
+            remote_only=False,
+            plan=False,
+            resume=False,
+            path=None,
+            annex_match=None,
+            object_store=None,
+            object_store_size=None):
+
+        ds = dataset.ds
+
+        if jobs in (None, 'auto'):
+            jobs = ds.config.obtain('datalad.runtime.max-jobs')
+        # a thread pool needs at least one worker
+        jobs = max(jobs, 1)
+        dataset_jobs = max(dataset_jobs, 1)
+        if link_mode is None:
+            # content from an object store is linked, rather than written
+            # twice
+            link_mode = 'auto' if object_store else 'copy'
+
+        res_kwargs = dict(
+            action='export_bagit',
+            logger=lgr,
+        )
+
+        # paths to limit the export to
+        selection = [
+            resolve_path(p, dataset.original) for p in ensure_list(path)
+        ] if path else None
+        annex_match = shlex.split(annex_match) if annex_match else None
+
+        # one bag for each revision, or the checked-out state
+        revisions = ensure_list(revision) or [None]
+        if len(revisions) > 1:
+            # each bag is named after its revision
+            bags = [(r, to / r.replace('/', '_')) for r in revisions]
+            bag_revisions = {}
+            for r, bag_to in bags:
+                other = bag_revisions.setdefault(bag_to, r)
+                if other != r or revisions.count(r) > 1:
+                    yield get_status_dict(
+                        ds=ds,
+                        status='impossible',
+                        message=('bags of revisions %r and %r would be '
+                                 'written to the same directory %s',
+                                 other, r, bag_to),
+                        **res_kwargs)
+                    return
+        else:
+            bags = [(revisions[0], to)]
+        revision = revisions[0]
+        # all datasets to export, discovered while the export progresses
+        datasets = _iter_datasets(
+            ds, revision, recursion_limit if recursive else 0, selection)
+
+        if str(to) == '-':
+            # there is no other way to write to stdout
+            stream = True
+            archive = archive or 'tar'
+        if stream:
+            if not archive:
+                yield get_status_dict(
+                    ds=ds,
+                    status='impossible',
+                    message='streaming requires an archive format',
+                    **res_kwargs)
+                return
+            if update:
+                yield get_status_dict(
+                    ds=ds,
+                    status='impossible',
+                    message='cannot update a streamed bag',
+                    **res_kwargs)
+                return
+            if bag_of_bags:
+                yield get_status_dict(
+                    ds=ds,
+                    status='impossible',
+                    message='cannot stream a bag of bags',
+                    **res_kwargs)
+                return
+            if len(bags) > 1:
+                yield get_status_dict(
+                    ds=ds,
+                    status='impossible',
+                    message='cannot stream bags of several revisions',
+                    **res_kwargs)
+                return
+            if plan:
+                yield from _plan_export(
+                    ds, datasets, None if str(to) == '-' else to.parent,
+                    revision is None, res_kwargs, file_urls=file_urls,
+                    remote_only=remote_only, selection=selection,
+                    annex_match=annex_match)
+                return
+            yield from _stream_bag(
+                ds, datasets, to, archive, revision is None, res_kwargs,
+                file_urls=file_urls, remote_only=remote_only,
+                selection=selection, annex_match=annex_match)
+            return
+
+        if plan:
+            for revision, bag_to in bags:
+                yield from _plan_export(
+                    ds,
+                    _iter_datasets(
+                        ds, revision, recursion_limit if recursive else 0,
+                        selection),
+                    bag_to, revision is None, res_kwargs,
+                    get_missing=get_missing, file_urls=file_urls,
+                    remote_only=remote_only, selection=selection,
+                    annex_match=annex_match)
+            return
+
+        yield from _export_bags(
+            ds,
+            bags,
+            res_kwargs,
+            jobs,
+            dataset_jobs,
+            link_mode,
+            recursion_limit=recursion_limit if recursive else 0,
+            selection=selection,
+            annex_match=annex_match,
+            update=update,
+            resume=resume,
+            bag_of_bags=bag_of_bags,
+            archive=archive,
+            get_missing=get_missing,
+            drop_fetched=drop_fetched,
+            file_urls=file_urls,
+            remote_only=remote_only,
+            object_store=object_store,
+            object_store_size=object_store_size)
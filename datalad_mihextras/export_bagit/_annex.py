@@ -0,0 +1,305 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""git-annex key information for a bag export"""
+
+__docformat__ = 'restructuredtext'
+
+
+import logging
+import re
+import sqlite3
+from contextlib import (
+    closing,
+    contextmanager,
+)
+from pathlib import (
+    Path,
+)
+
+from datalad_next.exceptions import CommandError
+
+from ._git import (
+    _GitBlobReader,
+)
+
+
+lgr = logging.getLogger('datalad.mihextras.export_bagit')
+
+# name of the key URL cache database in a repository's .git/datalad
+_key_url_cache_name = 'x_export_bagit_key_urls.sqlite'
+_key_url_cache_schema = """
+CREATE TABLE IF NOT EXISTS urls (key TEXT PRIMARY KEY, url TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS state (name TEXT PRIMARY KEY, value TEXT NOT NULL);
+"""
+
+# annex backends (lower-case, without the file name extension marker 'E')
+# whose key name is a hexdigest that can be used in a BagIt manifest as-is
+_key_digest_algorithms = frozenset((
+    'md5',
+    'sha1',
+    'sha224',
+    'sha256',
+    'sha384',
+    'sha512',
+    'sha3_224',
+    'sha3_256',
+    'sha3_384',
+    'sha3_512',
+))
+
+
+@contextmanager
+def _key_url_lookup(repo, merge=True):
+    """Provide a function that returns a URL to download a key's content from
+
+    The function returns None for a key without a URL. URLs are read from
+    the web location logs on the git-annex branch, via a cache (see
+    `_update_key_url_cache()`). They are looked up one key at a time, such
+    that no mapping of all keys needs to be held in memory.
+
+    With ``merge``, the git-annex branches of remotes are merged into the
+    local one first. Otherwise, or if merging fails (e.g., in a read-only
+    repository), the local git-annex branch is used as is.
+    """
+    if merge:
+        # make sure the git-annex branch has all information, like `whereis`
+        # would do too
+        try:
+            repo.call_annex(['merge'])
+        except CommandError as e:
+            lgr.debug('Cannot merge git-annex branch, using it as is: %s', e)
+    branch = repo.call_git_oneline(
+        ['rev-parse', '--verify', 'refs/heads/git-annex'], read_only=True)
+
+    with closing(_open_key_url_cache(repo)) as db:
+        _update_key_url_cache(repo, db, branch)
+
+        def get_url(key):
+            row = db.execute(
+                'SELECT url FROM urls WHERE key = ?', (key,)).fetchone()
+            return row[0] if row else None
+
+        yield get_url
+
+
+def _open_key_url_cache(repo):
+    """Return a connection to the key URL cache database of a repository
+
+    If the database cannot be opened, for example in a read-only
+    repository, an empty in-memory database is used instead.
+    """
+    path = Path(repo.dot_git, 'datalad', _key_url_cache_name)
+    try:
+        path.parent.mkdir(exist_ok=True, parents=True)
+        db = sqlite3.connect(str(path))
+        db.executescript(_key_url_cache_schema)
+    except (OSError, sqlite3.Error) as e:
+        lgr.debug('Cannot use key URL cache at %s: %s', path, e)
+        db = sqlite3.connect(':memory:')
+        db.executescript(_key_url_cache_schema)
+    return db
+
+
+def _update_key_url_cache(repo, db, branch):
+    """Update the key URL cache to the state of a git-annex branch commit
+
+    The cache records the branch commit it was built from. Only web
+    location logs that changed since this commit are read again. Without
+    a usable record, the cache is rebuilt from all logs.
+    """
+    row = db.execute(
+        "SELECT value FROM state WHERE name = 'branch'").fetchone()
+    cached = row[0] if row else None
+    if cached == branch:
+        return
+    lgr.info('Update key URL cache')
+    if cached and repo.commit_exists(cached):
+        paths = repo.call_git_items_(
+            ['diff-tree', '-r', '-z', '--no-renames', '--name-only',
+             cached, branch],
+            sep='\0',
+            read_only=True)
+    else:
+        # the branch may have been rewritten, start from scratch
+        db.execute('DELETE FROM urls')
+        paths = repo.call_git_items_(
+            ['ls-tree', '-r', '-z', '--name-only', branch],
+            sep='\0',
+            read_only=True)
+    with _GitBlobReader(repo) as reader:
+        for path in paths:
+            if not path.endswith('.log.web'):
+                continue
+            key = _get_log_path_key(path[:-len('.log.web')])
+            log = reader.read(f'{branch}:{path}')
+            url = _get_web_log_url(log) if log else None
+            if url:
+                db.execute(
+                    'INSERT OR REPLACE INTO urls VALUES (?, ?)', (key, url))
+            else:
+                db.execute('DELETE FROM urls WHERE key = ?', (key,))
+    db.execute(
+        "INSERT OR REPLACE INTO state VALUES ('branch', ?)", (branch,))
+    db.commit()
+
+
+def _get_log_path_key(path):
+    """Return the annex key of a log path on the git-annex branch
+
+    ``path`` must not include the extension that identifies the type of
+    log.
+    """
+    # undo the escaping that makes a key a valid file name
+    return re.sub(
+        r'&[acs]|%',
+        lambda m: {'&a': '&', '&c': ':', '&s': '%', '%': '/'}[m.group()],
+        path.rsplit('/', maxsplit=1)[-1],
+    )
+
+
+def _get_web_log_url(log):
+    """Return the most recently added, present URL in a web location log
+
+    Each log line is ``<timestamp>s <1|0> <url>``, reporting a URL as
+    present or removed. The most recent report for a URL wins. URLs with
+    a leading colon are not for download via HTTP and are ignored.
+    """
+    urls = {}
+    for line in log.decode('utf-8').splitlines():
+        timestamp, status, url = line.split(' ', maxsplit=2)
+        timestamp = float(timestamp.rstrip('s'))
+        if url not in urls or urls[url][0] < timestamp:
+            urls[url] = (timestamp, status == '1')
+    present = sorted(
+        ((timestamp, url) for url, (timestamp, status) in urls.items()
+         if status and not url.startswith(':')),
+        reverse=True,
+    )
+    return present[0][1] if present else None
+
+
+def _get_key_digest(backend, keyname):
+    """Return ``(algorithm, digest)`` of an annex key, if it is usable
+
+    ``None`` is returned for keys without a checksum, or with a checksum
+    type that is not supported for BagIt manifests.
+    """
+    if not backend or not keyname:
+        return None
+    backend = backend.lower()
+    if backend.endswith('e'):
+        # adjust for presence of file name extension
+        backend = backend[:-1]
+        keyname = keyname.split('.', maxsplit=1)[0]
+    if backend not in _key_digest_algorithms:
+        return None
+    return backend, keyname
+
+
+def _fetch_content(repo, missing, jobs, failed):
+    """Obtain missing annex key content with ``jobs`` parallel downloads
+
+    ``missing`` maps annex keys to a list of copies (see `_copy_payload()`)
+    that need their content. The copies are yielded as soon as the
+    content of their key is available. Keys whose content cannot be
+    obtained are recorded in the ``failed`` mapping, with an error
+    message.
+    """
+    lgr.info('Get missing content')
+    obtained = set()
+    error = 'content not obtained'
+    try:
+        for rec in repo._call_annex_records_items_(
+                ['get', '--batch-keys', f'--jobs={jobs}'],
+                stdin=''.join(f'{key}\n' for key in missing).encode(
+                    'utf-8')):
+            key = rec.get('key')
+            if not rec.get('success'):
+                failed[key] = ' '.join(rec.get('error-messages', [])) \
+                    or error
+                continue
+            obtained.add(key)
+            yield from missing[key]
+    except CommandError as e:
+        # any failure was reported for the respective key already
+        lgr.debug('Cannot get all missing content: %s', e)
+        error = str(e)
+    for key in missing:
+        if key not in obtained:
+            failed.setdefault(key, error)
+
+
+def _get_directory_remotes(repo):
+    """Return the directories of a repository's directory special remotes
+
+    Only remotes that store key content as-is, without encryption or
+    chunking, are considered.
+    """
+    remote_configs = _get_remote_configs(repo)
+    # remotes may have been set up by git-annex directly, without DataLad
+    # noticing
+    repo.config.reload()
+    dirs = []
+    for var in repo.config.keys():
+        match = re.fullmatch(r'remote\.(.+)\.annex-directory', var)
+        if not match:
+            continue
+        config = remote_configs.get(
+            repo.config.get(f'remote.{match.group(1)}.annex-uuid'), {})
+        if config.get('type') == 'directory' \
+                and config.get('encryption', 'none') == 'none' \
+                and not config.get('chunk'):
+            dirs.append(Path(repo.config.get(var)))
+    return dirs
+
+
+def _get_remote_configs(repo):
+    """Return the special remote configurations by UUID
+
+    They are read from the remote.log on the git-annex branch, where each
+    line is ``<uuid> <key>=<value> ... timestamp=<timestamp>s``. The most
+    recent configuration of a remote wins.
+    """
+    try:
+        log = repo.call_git(
+            ['cat-file', 'blob', 'git-annex:remote.log'],
+            expect_fail=True,
+            read_only=True)
+    except CommandError:
+        # no special remotes
+        return {}
+    configs = {}
+    for line in log.splitlines():
+        uuid, *fields = line.split()
+        config = dict(f.split('=', maxsplit=1) for f in fields if '=' in f)
+        timestamp = float(config.get('timestamp', '0').rstrip('s'))
+        if timestamp >= float(
+                configs.get(uuid, {}).get('timestamp', '0').rstrip('s')):
+            configs[uuid] = config
+    return configs
+
+
+def _find_directory_remote_object(dirs, key, hashdir):
+    """Return the path of a key's content in a directory special remote
+
+    ``hashdir`` is the lower-case hash directory of the key. None is
+    returned, if none of the remote ``dirs`` has the content.
+    """
+    keyfile = _get_key_file(key)
+    for d in dirs:
+        path = d / hashdir / keyfile / keyfile
+        if path.exists():
+            return path
+    return None
+
+
+def _get_key_file(key):
+    """Return the escaped form of an annex key that is a valid file name"""
+    return key.replace('&', '&a').replace('%', '&s').replace(
+        ':', '&c').replace('/', '%')
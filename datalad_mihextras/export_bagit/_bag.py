@@ -0,0 +1,297 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Read and write the manifests and tag files of a bag"""
+
+__docformat__ = 'restructuredtext'
+
+
+import logging
+import os
+import threading
+from datetime import datetime
+from itertools import chain
+from pathlib import (
+    Path,
+)
+
+from datalad_next.utils import chpwd
+
+from ._files import (
+    _hash_files,
+)
+
+
+lgr = logging.getLogger('datalad.mihextras.export_bagit')
+
+# serializes changes to the remote files of a bag, when exporting
+# datasets concurrently
+_remote_entries_lock = threading.Lock()
+
+# bag-info.txt tag to record the exported commit of each dataset
+_export_commit_tag = 'DataLad-Export-Commit'
+
+
+def _save_bag(bag, payload, algorithms, jobs=1, journal=None):
+    """Write the manifests, fetch.txt, and tag files of a bag
+
+    This replaces ``bag.save(manifests=True)``, which would re-read and
+    re-hash every single payload file. Instead, digests known from annex
+    keys are written into the manifests verbatim, and only files without
+    any known digest are hashed (with all of the given ``algorithms``),
+    using ``jobs`` processes, and only once for all hardlinks of a file.
+    Like remote files, a file with a key digest is only listed in the
+    manifest matching the key's backend.
+
+    ``payload`` maps bag-relative paths of all local payload files
+    (in POSIX convention) to ``(size, digests)`` tuples, where ``digests``
+    maps algorithm names to hexdigests.
+
+    Any computed digests are recorded in the ``journal``, which is removed
+    before the tag manifests are written.
+
+    Returns the saved bag, with reloaded manifests.
+    """
+    from bagit import _make_tagmanifest_file
+    from bdbag.bdbagit import (
+        BDBag,
+        _make_tag_file,
+    )
+    bag_path = Path(bag.path)
+    lgr.info('Hash payload files')
+    # hardlinked files are hashed only once
+    unhashed = {}
+    for relpath, (size, digests) in payload.items():
+        if not digests:
+            stat = (bag_path / relpath).stat()
+            unhashed.setdefault(
+                (stat.st_dev, stat.st_ino), []).append(relpath)
+    groups = {relpaths[0]: relpaths for relpaths in unhashed.values()}
+    for path, digests in _hash_files(
+            [bag_path / relpath for relpath in groups], algorithms, jobs):
+        for relpath in groups[path.relative_to(bag_path).as_posix()]:
+            payload[relpath] = (payload[relpath][0], digests)
+            if journal:
+                journal.record(relpath, *payload[relpath])
+
+    lgr.info('Build manifests')
+    manifests, oxum = _get_manifests(
+        payload, bag.remote_entries, algorithms)
+    for alg, content in manifests.items():
+        (bag_path / f'manifest-{alg}.txt').write_text(
+            content, encoding=bag.encoding)
+    fetch_path = bag_path / 'fetch.txt'
+    if bag.remote_entries:
+        fetch_path.write_text(
+            _get_fetch(bag.remote_entries), encoding=bag.encoding)
+    elif fetch_path.exists():
+        fetch_path.unlink()
+    bag.info['Payload-Oxum'] = oxum
+    if journal:
+        # the bag is complete, and the journal must not become a tag file
+        journal.finish()
+    with chpwd(bag.path):
+        # bdbag's tag file helpers work relative to the bag directory
+        _make_tag_file(bag.tag_file_name, bag.info)
+        for alg in manifests:
+            _make_tagmanifest_file(alg, bag.path, encoding=bag.encoding)
+    return BDBag(bag.path)
+
+
+def _get_manifests(payload, remote_entries, algorithms):
+    """Return the content of all payload manifests, and the Payload-Oxum
+
+    ``payload`` maps bag-relative paths of local payload files to
+    ``(size, digests)`` tuples, with all digests already known.
+    ``remote_entries`` has the structure of ``BDBag.remote_entries``.
+    A manifest is produced for each of the given ``algorithms``, and
+    any other algorithm found in the digests.
+    """
+    from bagit import _encode_filename
+    manifests = {alg: {} for alg in algorithms}
+    total_bytes = 0
+    for relpath, (size, digests) in payload.items():
+        for alg, digest in digests.items():
+            manifests.setdefault(alg, {})[relpath] = digest
+        total_bytes += size
+    for relpath, entry in remote_entries.items():
+        for alg, digest in entry.items():
+            if alg in ('url', 'length'):
+                continue
+            manifests.setdefault(alg, {})[relpath] = digest
+        total_bytes += int(entry['length'])
+    return {
+        alg: ''.join(
+            f'{entries[relpath]}  {_encode_filename(relpath)}\n'
+            for relpath in sorted(entries)
+        )
+        for alg, entries in manifests.items()
+    }, f'{total_bytes}.{len(payload) + len(remote_entries)}'
+
+
+def _get_fetch(remote_entries):
+    """Return the content of a fetch.txt file for the given remote files"""
+    from bdbag import escape_uri
+    return ''.join(
+        '{}\t{}\t{}\n'.format(
+            escape_uri(entry['url']),
+            entry['length'],
+            escape_uri(relpath, encode_whitespace=False, encode_other=True),
+        )
+        for relpath, entry in sorted(remote_entries.items())
+    )
+
+
+def _load_bag_payload(bag):
+    """Read the payload of an existing bag from its manifests and fetch.txt
+
+    All remote files are registered with the bag. A ``payload`` mapping,
+    as expected by `_save_bag()`, is returned for all local payload files.
+    No payload file content is read.
+    """
+    from bdbag import urlunquote
+    entries = bag.payload_entries()
+    for url, length, relpath in bag.fetch_entries():
+        relpath = urlunquote(relpath)
+        for alg, digest in entries.pop(relpath, {}).items():
+            bag.add_remote_file(relpath, url, int(length), alg, digest)
+    bag_path = Path(bag.path)
+    return {
+        relpath: ((bag_path / relpath).stat().st_size, digests)
+        for relpath, digests in entries.items()
+    }
+
+
+def _get_export_commits(bag):
+    """Return a mapping of dataset paths to commits recorded in a bag"""
+    records = bag.info.get(_export_commit_tag, [])
+    if isinstance(records, str):
+        records = [records]
+    commits = {}
+    for r in records:
+        commit, ds_relpath = r.split(' ', maxsplit=1)
+        commits[ds_relpath] = commit
+    return commits
+
+
+def _get_bag_relpath(ds_relpath):
+    """Return the path of a dataset in a bag, with a trailing slash"""
+    return 'data/' if ds_relpath == '.' else f'data/{ds_relpath}/'
+
+
+def _drop_payload_file(bag, payload, relpath):
+    """Remove a (local or remote) file from the payload of a bag"""
+    with _remote_entries_lock:
+        bag.remote_entries.pop(relpath, None)
+    if payload.pop(relpath, None) is None:
+        return
+    path = Path(bag.path) / relpath
+    if path.exists():
+        path.unlink()
+    # clean up directories that became empty
+    for parent in path.parents:
+        if parent.name == 'data' and parent.parent == Path(bag.path):
+            break
+        try:
+            parent.rmdir()
+        except OSError:
+            # not empty
+            break
+
+
+def _drop_stale_files(bag, payload, listed):
+    """Remove leftovers of a previous export from the payload directory
+
+    Only files that are not in ``payload``, but were ``listed`` as payload
+    of the bag before (bag-relative paths), are removed. Any other file
+    was not placed into the bag by an export, and is kept as payload
+    (to be hashed).
+    """
+    data_path = Path(bag.path) / 'data'
+    for root, dirs, files in os.walk(data_path, topdown=False):
+        root = Path(root)
+        for name in files:
+            path = root / name
+            relpath = path.relative_to(bag.path).as_posix()
+            if relpath in payload:
+                continue
+            if relpath in listed:
+                lgr.debug('Remove stale payload file %s', path)
+                path.unlink()
+            else:
+                lgr.warning('Keep unknown file %s in bag payload', path)
+                payload[relpath] = (path.stat().st_size, {})
+        if root != data_path and not any(root.iterdir()):
+            root.rmdir()
+
+
+def _drop_dataset_payload(bag, payload, ds_relpath, keep):
+    """Remove all files of a dataset from the payload of a bag
+
+    Files of any (sub)dataset whose path is in ``keep`` are not removed.
+    """
+    prefix = _get_bag_relpath(ds_relpath)
+    keep = [
+        k for k in (_get_bag_relpath(d) for d in keep)
+        if k.startswith(prefix) and len(k) > len(prefix)
+    ]
+    for relpath in [
+            p for p in chain(payload, bag.remote_entries)
+            if p.startswith(prefix)
+            and not any(p.startswith(k) for k in keep)]:
+        _drop_payload_file(bag, payload, relpath)
+
+
+def _get_new_bag_config():
+    """Return bagit.txt content, bag-info metadata, and algorithms
+
+    This matches what bdbag would use for a new bag with the present
+    configuration.
+    """
+    from bdbag import (
+        BAGIT_VERSION,
+        PROJECT_URL,
+        VERSION,
+    )
+    from bdbag.bdbag_config import (
+        BAG_ALGORITHMS_TAG,
+        BAG_CONFIG_TAG,
+        BAG_METADATA_TAG,
+        BAG_SPEC_VERSION_TAG,
+        DEFAULT_BAG_ALGORITHMS,
+        DEFAULT_BAG_SPEC_VERSION,
+        read_config,
+    )
+    config = read_config()[BAG_CONFIG_TAG]
+    bagit_txt = (
+        'BagIt-Version: '
+        f'{config.get(BAG_SPEC_VERSION_TAG, DEFAULT_BAG_SPEC_VERSION)}\n'
+        'Tag-File-Character-Encoding: UTF-8\n'
+    )
+    info = dict(config.get(BAG_METADATA_TAG, {}))
+    now = datetime.now().astimezone()
+    info.setdefault('Bagging-Date', now.strftime('%Y-%m-%d'))
+    info.setdefault('Bagging-Time', now.strftime('%H:%M:%S %Z'))
+    info.setdefault(
+        'Bag-Software-Agent',
+        f'BDBag version: {VERSION} (Bagit version: {BAGIT_VERSION}) '
+        f'<{PROJECT_URL}>')
+    algorithms = config.get(BAG_ALGORITHMS_TAG, DEFAULT_BAG_ALGORITHMS)
+    return bagit_txt, info, list(algorithms)
+
+
+def _get_tag_file(info):
+    """Return the content of a tag file (like bag-info.txt)"""
+    lines = []
+    for label in sorted(info):
+        values = info[label]
+        for value in values if isinstance(values, list) else [values]:
+            # strip CR and LF, they would break the format
+            value = str(value).replace('\r', '').replace('\n', '')
+            lines.append(f'{label}: {value}\n')
+    return ''.join(lines)
@@ -0,0 +1,286 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Export datasets into bag directories"""
+
+__docformat__ = 'restructuredtext'
+
+
+import logging
+from concurrent.futures import (
+    ThreadPoolExecutor,
+    as_completed,
+)
+from functools import partial
+from pathlib import (
+    Path,
+)
+
+from datalad_next.commands import (
+    get_status_dict,
+)
+
+from ._bag import (
+    _drop_dataset_payload,
+    _drop_payload_file,
+    _drop_stale_files,
+    _export_commit_tag,
+    _get_export_commits,
+    _load_bag_payload,
+    _save_bag,
+)
+from ._export import (
+    _export_bagit,
+)
+from ._git import (
+    _iter_datasets,
+)
+from ._journal import (
+    _ExportJournal,
+)
+from ._store import (
+    _ObjectStore,
+)
+from ._stream import (
+    _stream_bag,
+)
+
+
+lgr = logging.getLogger('datalad.mihextras.export_bagit')
+
+
+def _export_bags(ds, bags, res_kwargs, jobs, dataset_jobs, link_mode,
+                 recursion_limit=None, selection=None, annex_match=None,
+                 update=False, resume=False, bag_of_bags=False, archive=None,
+                 get_missing=False, drop_fetched=False, file_urls=False,
+                 remote_only=False, object_store=None,
+                 object_store_size=None):
+    """Yield the results of exporting a dataset into bag directories
+
+    ``bags`` is a list of the revision to export (``None`` for the
+    worktree) and the directory of its bag.
+    """
+    # TODO this reconfigures DataLad log handling and doubles all reporting
+    from bdbag import bdbag_api as bi
+    from bdbag.bdbagit import (
+        BagError,
+        BDBag,
+    )
+    store = _ObjectStore(object_store, object_store_size) \
+        if object_store else None
+    # path and digests of a payload file in the bag of any version, by
+    # the annex key or blob of its content
+    versions = {}
+    for revision, bag_to in bags:
+        if not bag_to.exists():
+            bag_to.mkdir(exist_ok=True, parents=True)
+        bag = None
+        if update:
+            try:
+                bag = BDBag(str(bag_to))
+            except BagError as e:
+                lgr.info(
+                    'No existing bag to update, starting from scratch: '
+                    '%s', e)
+        # whether the bag is exported anew, even if it exists already
+        fresh = bag is None
+        if fresh and not (bag_to / 'bagit.txt').exists() \
+                and any(bag_to.iterdir()):
+            # bdbag would turn any content into payload, and the
+            # export would not account for it
+            yield get_status_dict(
+                ds=ds,
+                status='impossible',
+                path=str(bag_to),
+                message=('refusing to export into non-empty directory '
+                         '%s, which is not a bag', bag_to),
+                **res_kwargs)
+            continue
+        if bag is None:
+            bag = bi.make_bag(str(bag_to))
+            # information on all local payload files for building the
+            # manifests
+            payload = {}
+            previous_commits = {}
+        else:
+            payload = _load_bag_payload(bag)
+            previous_commits = _get_export_commits(bag)
+        journal = _ExportJournal(bag.path, resume=resume)
+        # payload files of a previous export into the same bag, which
+        # may be removed
+        listed = set(bag.payload_entries()).union(journal.get_paths()) \
+            if fresh else set()
+        # files without a digest from an annex key are hashed with all
+        # algorithms the bag was configured for
+        algorithms = list(bag.algorithms)
+        # commits exported for each dataset, by path relative to `ds`
+        commits = {}
+        # bag-relative path of a payload file with the content of an annex
+        # key, for linking identical files across datasets
+        key_paths = {}
+        # annex key or blob of each payload file placed into the bag
+        contents = {}
+        datasets = _iter_datasets(
+            ds, revision, recursion_limit, selection)
+
+        with ThreadPoolExecutor(max_workers=dataset_jobs) as executor:
+            futures = []
+            for d, commit, error in datasets:
+                if error:
+                    yield get_status_dict(
+                        ds=d,
+                        status='error',
+                        message=error,
+                        **res_kwargs)
+                    continue
+                d_relpath = d.pathobj.relative_to(ds.pathobj).as_posix()
+                if bag_of_bags and d != ds:
+                    export = partial(
+                        _export_subbag,
+                        ds,
+                        d,
+                        res_kwargs,
+                        commit,
+                        bag,
+                        payload,
+                        commits,
+                        archive or 'zip',
+                        since=previous_commits.get(d_relpath),
+                        worktree=revision is None,
+                        file_urls=file_urls,
+                        remote_only=remote_only,
+                        selection=selection,
+                        annex_match=annex_match,
+                    )
+                else:
+                    export = partial(
+                        _export_dataset,
+                        ds,
+                        d,
+                        res_kwargs,
+                        commit,
+                        bag,
+                        payload,
+                        algorithms,
+                        commits,
+                        jobs,
+                        link_mode,
+                        since=previous_commits.get(d_relpath),
+                        worktree=revision is None,
+                        get_missing=get_missing,
+                        drop_fetched=drop_fetched,
+                        file_urls=file_urls,
+                        remote_only=remote_only,
+                        selection=selection,
+                        annex_match=annex_match,
+                        journal=journal,
+                        key_paths=key_paths,
+                        store=store,
+                        versions=versions,
+                        contents=contents,
+                    )
+                if dataset_jobs < 2:
+                    yield from export()
+                else:
+                    futures.append(executor.submit(
+                        lambda export=export: list(export())))
+            for future in as_completed(futures):
+                yield from future.result()
+        for ds_relpath in set(previous_commits).difference(commits):
+            # a previously exported dataset is no longer around
+            _drop_dataset_payload(bag, payload, ds_relpath, commits)
+            if bag_of_bags:
+                _drop_payload_file(
+                    bag, payload, f'data/{ds_relpath}.{archive or "zip"}')
+        if fresh:
+            # leftovers of any previous export are not part of this one
+            _drop_stale_files(bag, payload, listed)
+        bag.info[_export_commit_tag] = [
+            f'{commit} {ds_relpath}'
+            for ds_relpath, commit in sorted(commits.items())
+        ]
+        bag = _save_bag(bag, payload, algorithms, jobs, journal=journal)
+        # all digests are known now, to be reused for other versions
+        for relpath, content in contents.items():
+            if relpath in payload:
+                versions.setdefault(
+                    content,
+                    (Path(bag.path) / relpath, payload[relpath][1]))
+        if not remote_only:
+            # a holey bag is complete by construction, no need to walk it
+            bag.validate(completeness_only=True)
+        if archive:
+            archive_path = bi.archive_bag(bag.path, archive)
+            yield get_status_dict(
+                status='ok',
+                type='bag',
+                path=archive_path,
+                **res_kwargs)
+    if store:
+        store.evict()
+
+
+def _export_dataset(rootds, ds, res_kwargs, *args, **kwargs):
+    """Yield the results of `_export_bagit()` for a dataset
+
+    Any ValueError is reported as an error result.
+    """
+    try:
+        for res in _export_bagit(rootds, ds, *args, **kwargs):
+            yield dict(get_status_dict(ds=ds, **res_kwargs), **res)
+    except ValueError as e:
+        yield get_status_dict(
+            ds=ds,
+            status='error',
+            message=str(e),
+            **res_kwargs)
+
+
+def _export_subbag(rootds, ds, res_kwargs, commit, bag, payload, commits,
+                   archive, since=None, worktree=True, file_urls=False,
+                   remote_only=False, selection=None, annex_match=None):
+    """Yield the results of exporting a dataset into a bag of its own
+
+    The bag is written as an archive into the payload of ``bag``, at the
+    location of the dataset. An existing archive is kept, if the dataset
+    is unchanged since the last export (``since``).
+    """
+    ds_relpath = ds.pathobj.relative_to(rootds.pathobj).as_posix()
+    relpath = f'data/{ds_relpath}.{archive}'
+    if since == commit and relpath in payload:
+        commits[ds_relpath] = commit
+        yield get_status_dict(
+            ds=ds,
+            status='notneeded',
+            message='bag unchanged since last export',
+            **res_kwargs)
+        return
+    _drop_payload_file(bag, payload, relpath)
+    archive_path = None
+    failed = False
+    for res in _stream_bag(
+            ds,
+            [(ds, commit, None)],
+            Path(bag.path) / 'data' / ds_relpath,
+            archive,
+            worktree,
+            res_kwargs,
+            file_urls=file_urls,
+            remote_only=remote_only,
+            selection=selection,
+            annex_match=annex_match):
+        failed = failed or res['status'] == 'error'
+        if res.get('type') == 'bag':
+            archive_path = Path(res['path'])
+        yield res
+    if failed:
+        # do not leave a bag with an incomplete export behind
+        archive_path.unlink()
+        return
+    commits[ds_relpath] = commit
+    payload[relpath] = (archive_path.stat().st_size, {})
@@ -0,0 +1,408 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Export the content of a dataset into a bag directory"""
+
+__docformat__ = 'restructuredtext'
+
+
+import logging
+import os
+from pathlib import (
+    Path,
+)
+
+from datalad_next.commands import (
+    get_status_dict,
+)
+from datalad_next.exceptions import CommandError
+
+from ._annex import (
+    _fetch_content,
+)
+from ._bag import (
+    _drop_dataset_payload,
+    _drop_payload_file,
+    _get_bag_relpath,
+    _remote_entries_lock,
+)
+from ._files import (
+    _copy_payload,
+    _link_file,
+    _matches_key_digest,
+)
+from ._git import (
+    _check_clean,
+    _get_changed_files,
+    _get_subdataset_commits,
+    _GitBlobReader,
+)
+from ._payload import (
+    _iter_payload,
+)
+
+
+lgr = logging.getLogger('datalad.mihextras.export_bagit')
+
+
+def _export_bagit(rootds, ds, export_treeish, bag, payload, algorithms,
+                  commits, jobs=1, link_mode='copy', since=None,
+                  worktree=True, get_missing=False, drop_fetched=False,
+                  file_urls=False, remote_only=False, selection=None,
+                  annex_match=None, journal=None, key_paths=None,
+                  store=None, versions=None, contents=None):
+    """Yield the results of exporting the files of a dataset into a bag
+
+    The files of ``ds`` at ``export_treeish`` are placed into the bag
+    directory of ``bag``, at the location of the dataset relative to
+    ``rootds``, or registered as remote files (see `_iter_payload()`,
+    which also receives ``worktree``, ``file_urls``, ``remote_only``,
+    ``selection``, and ``annex_match``). Each placed file is added to the
+    ``payload`` mapping (see `_save_bag()`). Files without digests from
+    an annex key are hashed with ``algorithms`` while they are copied.
+    Copies are made by ``jobs`` threads, according to ``link_mode`` (see
+    `_copy_payload()`). Once the dataset is completely exported,
+    ``export_treeish`` is recorded in the ``commits`` mapping, by the
+    path of the dataset relative to ``rootds``.
+
+    With ``since``, the commit of a previous export into the same bag,
+    only files changed since then are replaced. If this commit is
+    unknown, the dataset's payload is replaced entirely.
+
+    With ``get_missing``, absent annex key content is obtained, and with
+    ``drop_fetched``, it is dropped again afterwards. Files whose content
+    is not available are reported, and left out of the bag.
+
+    Any of the following mappings are shared across the exports of all
+    datasets (and bags), and are updated as files are placed into the
+    bag. A ``journal`` (see `_ExportJournal`) records placed files, and
+    provides those placed by an interrupted export before. ``key_paths``
+    maps annex keys to the bag-relative path of a file with their
+    content, to which any other file with the same key is hardlinked.
+    Key content is placed via an object ``store`` (see `_ObjectStore`).
+    ``versions`` maps annex keys and Git blobs to the path and digests
+    of a file with this content in the bag of another version, to be
+    linked to instead of copied, and ``contents`` receives the key or
+    blob of each placed file, by its bag-relative path.
+
+    A ValueError is raised, if the dataset cannot be exported at all.
+    """
+    repo = ds.repo
+
+    return_props = dict(
+    )
+
+    bag_path = Path(bag.path)
+
+    ds_relpath = ds.pathobj.relative_to(rootds.pathobj).as_posix()
+    paths = None
+    if since == export_treeish:
+        commits[ds_relpath] = export_treeish
+        yield get_status_dict(
+            status='notneeded',
+            message='unchanged since last export',
+            **return_props)
+        return
+    if worktree:
+        _check_clean(repo)
+    if since and not repo.commit_exists(since):
+        lgr.warning(
+            'Previously exported commit %s of %s not found, exporting the '
+            'dataset in full', since, ds)
+        # the payload of the dataset is replaced, not that of subdatasets
+        _drop_dataset_payload(
+            bag,
+            payload,
+            ds_relpath,
+            [p if ds_relpath == '.' else f'{ds_relpath}/{p}'
+             for p, _ in _get_subdataset_commits(repo, export_treeish)],
+        )
+        since = None
+    if since:
+        lgr.info('Get changes since last export')
+        paths = set()
+        for path, deleted in _get_changed_files(repo, since, export_treeish):
+            # anything changed gets removed, and is re-added below
+            _drop_payload_file(
+                bag,
+                payload,
+                f'{_get_bag_relpath(ds_relpath)}{path}',
+            )
+            if not deleted:
+                paths.add(path)
+    if paths == set():
+        # nothing left to do
+        commits[ds_relpath] = export_treeish
+        yield get_status_dict(
+            status='ok',
+            **return_props)
+        return
+
+    # files to be copied into the bag, processed in bulk at the end
+    copies = []
+    # dataset file paths to report for the copies, by target path
+    copy_paths = {}
+    # copies that need annex key content to be obtained first, by key
+    missing = {}
+    # git blobs to be written into the bag
+    blobs = []
+    # payload files registered so far
+    added = []
+    # key of the content of each copy, by target path
+    copy_keys = {}
+    copied_keys = set()
+    # key digests to check copied content against, by target path
+    verify = {}
+    # files to be linked to a copy of the same key content, placed into the
+    # bag by this or any other dataset's export
+    links = []
+    if key_paths is None:
+        key_paths = {}
+    try:
+        for item in _iter_payload(
+                rootds, ds, export_treeish, paths, worktree=worktree,
+                file_urls=file_urls, remote_only=remote_only,
+                selection=selection, annex_match=annex_match):
+            filepath = item['path']
+            bag_relpath = item['bag_relpath']
+            key_digest = item['key_digest']
+            if item['url']:
+                # we can register it as a remote file
+                with _remote_entries_lock:
+                    bag.add_remote_file(
+                        bag_relpath,
+                        item['url'],
+                        item['bytesize'],
+                        *key_digest,
+                    )
+                added.append(bag_relpath)
+                yield get_status_dict(
+                    status='ok',
+                    path=str(filepath),
+                    type='file',
+                    message='registered as a remote file',
+                    **return_props)
+                continue
+            target_path = bag_path / bag_relpath
+            digests = journal.get(bag_relpath, item['bytesize']) \
+                if journal else None
+            if digests is not None:
+                # placed into the bag by an interrupted export already
+                payload[bag_relpath] = (item['bytesize'], digests)
+                added.append(bag_relpath)
+                if item['key']:
+                    key_paths.setdefault(item['key'], bag_relpath)
+                yield get_status_dict(
+                    status='notneeded',
+                    path=str(filepath),
+                    type='file',
+                    message='already in bag',
+                    **return_props)
+                continue
+            target_path.parent.mkdir(exist_ok=True, parents=True)
+            content = item['key'] or item['blob']
+            if content and contents is not None:
+                contents[bag_relpath] = content
+            if content in (versions or {}):
+                # identical content is in the bag of another version
+                src, digests = versions[content]
+                method = _link_file(src, target_path)
+                payload[bag_relpath] = (
+                    target_path.stat().st_size, digests)
+                added.append(bag_relpath)
+                if journal:
+                    journal.record(bag_relpath, *payload[bag_relpath])
+                yield get_status_dict(
+                    status='ok',
+                    path=str(filepath),
+                    type='file',
+                    message=f'{method} from bag of another version',
+                    **return_props)
+                continue
+            if item['blob']:
+                blobs.append((filepath, target_path, item['blob']))
+                continue
+            key = item['key']
+            if not item['present'] and item['bytesize'] is None:
+                # without a size from the key, only present content can be
+                # accounted for
+                yield get_status_dict(
+                    status='impossible',
+                    path=str(filepath),
+                    type='file',
+                    message='file content not available locally, '
+                            'and its size is unknown',
+                    **return_props)
+                continue
+            # content in the object store needs not be obtained
+            present = item['present'] or bool(store and key in store)
+            if not (present or get_missing):
+                yield get_status_dict(
+                    status='impossible',
+                    path=str(filepath),
+                    type='file',
+                    message='file content not available locally',
+                    **return_props)
+                continue
+            copy_paths[target_path] = filepath
+            payload[bag_relpath] = (
+                item['bytesize'], dict([key_digest]) if key_digest else {})
+            added.append(bag_relpath)
+            if key in key_paths or key in copied_keys:
+                # identical content is placed into the bag already
+                links.append((target_path, key))
+                continue
+            if key:
+                copy_keys[target_path] = key
+                copied_keys.add(key)
+            if item['unverified']:
+                # hashed while copying, to be checked against the key
+                verify[target_path] = key_digest
+            # a key digest saves us from hashing the file
+            copy = (
+                item['source'],
+                target_path,
+                item['bytesize'],
+                item['annex_object'],
+                [key_digest[0]] if item['unverified']
+                else None if key_digest else algorithms,
+                key,
+            )
+            if present:
+                copies.append(copy)
+            else:
+                missing.setdefault(key, []).append(copy)
+    except ValueError:
+        # leave no trace of an incomplete export of the dataset
+        for bag_relpath in added:
+            _drop_payload_file(bag, payload, bag_relpath)
+        raise
+
+    if blobs:
+        with _GitBlobReader(repo) as reader:
+            for filepath, target_path, sha in blobs:
+                if os.path.lexists(target_path):
+                    os.unlink(target_path)
+                size, digests = reader.copy(sha, target_path, algorithms)
+                bag_relpath = target_path.relative_to(bag_path).as_posix()
+                payload[bag_relpath] = (size, digests)
+                if journal:
+                    journal.record(bag_relpath, size, digests)
+                yield get_status_dict(
+                    status='ok',
+                    path=str(filepath),
+                    type='file',
+                    message='copied into bag',
+                    **return_props)
+
+    # error messages of key content that could not be obtained
+    failed = {}
+    for source, target_path, method, digests in _copy_payload(
+            copies,
+            jobs,
+            link_mode,
+            fetched=_fetch_content(repo, missing, jobs, failed)
+            if missing else None,
+            store=store):
+        bag_relpath = target_path.relative_to(bag_path).as_posix()
+        if target_path in verify and not _matches_key_digest(
+                target_path, verify[target_path], digests):
+            key = copy_keys[target_path]
+            failed[key] = f'{verify[target_path][0]} checksum mismatch ' \
+                f'of {source}'
+            _drop_payload_file(bag, payload, bag_relpath)
+            if store:
+                store.discard(key)
+            yield get_status_dict(
+                status='error',
+                path=str(copy_paths[target_path]),
+                type='file',
+                message=('invalid file content: %s', failed[key]),
+                **return_props)
+            continue
+        if digests:
+            # hand digests computed while copying to the manifest writer
+            payload[bag_relpath] = (payload[bag_relpath][0], digests)
+        if journal:
+            journal.record(bag_relpath, *payload[bag_relpath])
+        if target_path in copy_keys:
+            # the first copy of a key's content that completes is the one
+            # to link to, across all datasets
+            key_paths.setdefault(copy_keys[target_path], bag_relpath)
+        yield get_status_dict(
+            status='ok',
+            path=str(copy_paths[target_path]),
+            type='file',
+            message=f'{method} into bag',
+            **return_props)
+
+    for key, error in failed.items():
+        for copy in missing.get(key, []):
+            # the file is not in the bag, the rest of the export is fine
+            target_path = copy[1]
+            _drop_payload_file(
+                bag, payload, target_path.relative_to(bag_path).as_posix())
+            yield get_status_dict(
+                status='error',
+                path=str(copy_paths[target_path]),
+                type='file',
+                message=('cannot obtain file content: %s', error),
+                **return_props)
+
+    for target_path, key in links:
+        bag_relpath = target_path.relative_to(bag_path).as_posix()
+        src_relpath = key_paths.get(key)
+        if src_relpath is None:
+            # the content of the key could not be obtained
+            _drop_payload_file(bag, payload, bag_relpath)
+            yield get_status_dict(
+                status='error',
+                path=str(copy_paths[target_path]),
+                type='file',
+                message=('cannot obtain file content: %s',
+                         failed.get(key, 'content not obtained')),
+                **return_props)
+            continue
+        method = _link_file(bag_path / src_relpath, target_path)
+        # identical content, identical digests
+        payload[bag_relpath] = (
+            payload[bag_relpath][0],
+            payload[src_relpath][1] or payload[bag_relpath][1])
+        if journal:
+            journal.record(bag_relpath, *payload[bag_relpath])
+        yield get_status_dict(
+            status='ok',
+            path=str(copy_paths[target_path]),
+            type='file',
+            message=f'{method} from identical file in bag',
+            **return_props)
+
+    if missing and drop_fetched:
+        lgr.info('Drop fetched content')
+        try:
+            for rec in repo._call_annex_records_items_(
+                    ['drop', '--batch-keys'],
+                    stdin=''.join(f'{key}\n' for key in missing).encode(
+                        'utf-8')):
+                if not rec.get('success'):
+                    yield get_status_dict(
+                        status='error',
+                        message=('cannot drop fetched content of %s: %s',
+                                 rec.get('key'),
+                                 ' '.join(rec.get('error-messages', []))),
+                        **return_props)
+        except CommandError as e:
+            # any failure was reported for the respective key already
+            lgr.debug('Cannot drop all fetched content: %s', e)
+
+    # only a completed export is recorded, anything else is exported again
+    # by an update
+    commits[ds_relpath] = export_treeish
+    yield get_status_dict(
+        status='ok',
+        **return_props)
@@ -0,0 +1,284 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Hash and place the payload files of a bag"""
+
+__docformat__ = 'restructuredtext'
+
+
+import hashlib
+import logging
+import mmap
+import os
+import queue
+import threading
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
+from contextlib import (
+    nullcontext,
+)
+from functools import partial
+from shutil import (
+    copyfile,
+)
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # not available on windows
+    fcntl = None
+
+
+lgr = logging.getLogger('datalad.mihextras.export_bagit')
+
+# ioctl request code for cloning a file on a copy-on-write filesystem
+# (Linux: _IOW(0x94, 9, int))
+_FICLONE = 0x40049409
+
+# block size for reading file content
+_BLOCK_SIZE = 1024 * 1024
+# files larger than this are memory-mapped for hashing
+_MMAP_THRESHOLD = 64 * 1024 * 1024
+_MMAP_BLOCK_SIZE = 16 * 1024 * 1024
+# number of files handed to a hashing process at once
+_HASH_CHUNKSIZE = 64
+
+
+def _hash_file(path, algorithms, copy_to=None):
+    """Return a mapping of algorithm names to hexdigests of a file
+
+    If ``copy_to`` is given, the file content is also written to this
+    location, in the same pass that computes the digests.
+    """
+    hashers = {alg: hashlib.new(alg) for alg in algorithms}
+    if copy_to is None and os.stat(path).st_size >= _MMAP_THRESHOLD:
+        with open(path, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            # hash in blocks to let all hashers work on the same
+            # pages while they are hot in the CPU caches
+            with memoryview(mm) as view:
+                for start in range(0, len(view), _MMAP_BLOCK_SIZE):
+                    with view[start:start + _MMAP_BLOCK_SIZE] as chunk:
+                        for h in hashers.values():
+                            h.update(chunk)
+        return {alg: h.hexdigest() for alg, h in hashers.items()}
+    with open(path, 'rb') as f, \
+            open(copy_to, 'wb') if copy_to else nullcontext() as dst:
+        while True:
+            chunk = f.read(_BLOCK_SIZE)
+            if not chunk:
+                break
+            if dst:
+                dst.write(chunk)
+            for h in hashers.values():
+                h.update(chunk)
+    return {alg: h.hexdigest() for alg, h in hashers.items()}
+
+
+def _matches_key_digest(path, key_digest, digests=None):
+    """Return whether the content of a file matches an annex key's digest
+
+    Any ``digests`` known for the file already are used, if they include
+    the key's algorithm. Otherwise the file is hashed.
+    """
+    alg, digest = key_digest
+    if alg not in (digests or {}):
+        digests = _hash_file(path, [alg])
+    return digests[alg] == digest
+
+
+def _hash_files(paths, algorithms, jobs=1):
+    """Hash files, distributed across a pool of ``jobs`` processes
+
+    Yields ``(path, digests)`` tuples in the order of ``paths``, where
+    ``digests`` maps algorithm names to hexdigests.
+    """
+    hash_file = partial(_hash_file, algorithms=algorithms)
+    if jobs < 2 or len(paths) < 2:
+        for path in paths:
+            yield path, hash_file(path)
+        return
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        yield from zip(
+            paths,
+            executor.map(hash_file, paths, chunksize=_HASH_CHUNKSIZE),
+        )
+
+
+def _reflink(src, dst):
+    """Clone the content of ``src`` into ``dst`` without copying data
+
+    Raises ``OSError`` when the filesystem does not support this.
+    """
+    if fcntl is None:
+        raise OSError(f'Cannot reflink {src}, unsupported platform')
+    try:
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+    except OSError:
+        # do not leave an empty file behind, that would block a hardlink
+        if os.path.lexists(dst):
+            os.unlink(dst)
+        raise
+
+
+def _copy_file_range(src, dst):
+    """Copy ``src`` to ``dst`` via ``copy_file_range()``
+
+    Filesystems with copy-on-write support will share data blocks instead
+    of copying them, network filesystems may perform a server-side copy.
+    Raises ``OSError`` when this is not possible.
+    """
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError(f'Cannot copy_file_range {src}, unsupported platform')
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        remaining = os.fstat(fsrc.fileno()).st_size
+        while remaining > 0:
+            copied = os.copy_file_range(
+                fsrc.fileno(), fdst.fileno(), remaining)
+            if not copied:
+                raise OSError(f'Unexpected end of file {src}')
+            remaining -= copied
+
+
+def _place_file(src, dst, link_mode, annex_object=None, algorithms=None):
+    """Place the content of a single file into a bag
+
+    ``annex_object`` is the path of the file's annex object, if there is
+    any. Only such objects are hardlinked, because the content of a file
+    in the worktree could be modified. Whenever a link cannot be created,
+    the file is copied. If ``algorithms`` are given, a copy is made in
+    the same pass that computes the respective digests.
+
+    Returns a tuple with a label for the method that was used, and
+    a mapping of algorithm names to hexdigests (empty, if the file was
+    linked).
+    """
+    if os.path.lexists(dst):
+        # never write into an existing file, it could be a hardlink
+        # to an annex object from a previous export
+        os.unlink(dst)
+    src = annex_object or src
+    if link_mode in ('reflink', 'auto'):
+        try:
+            _reflink(src, dst)
+            return 'reflinked', {}
+        except OSError as e:
+            lgr.debug('Cannot reflink %s: %s', src, e)
+    if link_mode in ('hardlink', 'auto') and annex_object:
+        try:
+            os.link(annex_object, dst)
+            return 'hardlinked', {}
+        except OSError as e:
+            lgr.debug('Cannot hardlink %s: %s', src, e)
+    if algorithms:
+        # content has to be read anyway, hash it on the way
+        return 'copied', _hash_file(src, algorithms, copy_to=dst)
+    if link_mode in ('reflink', 'auto'):
+        try:
+            _copy_file_range(src, dst)
+            return 'copied', {}
+        except OSError as e:
+            lgr.debug('Cannot copy_file_range %s: %s', src, e)
+    copyfile(src, dst, follow_symlinks=True)
+    return 'copied', {}
+
+
+def _link_file(src, dst):
+    """Hardlink ``dst`` to ``src``, or copy it, if that is not possible
+
+    Returns a label for the method that was used.
+    """
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    try:
+        os.link(src, dst)
+        return 'hardlinked'
+    except OSError as e:
+        lgr.debug('Cannot hardlink %s: %s', src, e)
+    copyfile(src, dst)
+    return 'copied'
+
+
+def _copy_payload(copies, jobs, link_mode='copy', fetched=None, store=None):
+    """Place files into a bag using a pool of ``jobs`` threads
+
+    ``copies`` is an iterable of
+    ``(source, target, size, annex_object, algorithms, key)`` tuples, with
+    ``key`` being None for a file that is not annex'ed. With a ``store``
+    (see `_ObjectStore`), the content of annex keys is placed via the
+    store. Copies are
+    scheduled largest-first, such that the total runtime is not dominated
+    by a large file that happens to be started last. ``fetched`` is an
+    optional iterable of more such tuples, whose content only becomes
+    available while it is consumed (see `_fetch_content()`). It is consumed
+    in a separate thread, and each copy is started as soon as it is
+    reported.
+    ``(source, target, method, digests)`` is yielded for each copy as soon
+    as it has completed.
+    """
+    # all threads report back to the calling thread via this queue
+    messages = queue.Queue()
+
+    def place(src, dst, size, annex_object, algorithms, key):
+        try:
+            messages.put(('done', (src, dst) + (
+                store.place(
+                    key, src, dst, link_mode, annex_object, algorithms)
+                if store and key else _place_file(
+                    src, dst, link_mode, annex_object, algorithms))))
+        except Exception as e:
+            messages.put(('error', e))
+
+    def fetch():
+        try:
+            for copy in fetched:
+                messages.put(('copy', copy))
+            messages.put(('fetched', None))
+        except Exception as e:
+            messages.put(('error', e))
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = 0
+        for copy in sorted(copies, key=lambda c: c[2], reverse=True):
+            executor.submit(place, *copy)
+            pending += 1
+        fetching = fetched is not None
+        if fetching:
+            threading.Thread(target=fetch, daemon=True).start()
+        while pending or fetching:
+            kind, value = messages.get()
+            if kind == 'error':
+                # raises any exception from the copy or fetch operation
+                raise value
+            elif kind == 'copy':
+                executor.submit(place, *value)
+                pending += 1
+            elif kind == 'fetched':
+                fetching = False
+            else:
+                pending -= 1
+                yield value
+
+
+class _HashingReader:
+    """Wrapper of a binary file object that hashes all content read"""
+    def __init__(self, fileobj, algorithms):
+        self._fileobj = fileobj
+        self._hashers = {alg: hashlib.new(alg) for alg in algorithms}
+
+    def read(self, size=-1):
+        chunk = self._fileobj.read(size)
+        for h in self._hashers.values():
+            h.update(chunk)
+        return chunk
+
+    def hexdigests(self):
+        return {alg: h.hexdigest() for alg, h in self._hashers.items()}
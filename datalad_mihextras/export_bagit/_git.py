@@ -0,0 +1,348 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Read trees, blobs, and datasets from Git"""
+
+__docformat__ = 'restructuredtext'
+
+
+import logging
+import queue
+import re
+from contextlib import (
+    contextmanager,
+)
+from shutil import (
+    copyfileobj,
+)
+
+from datalad_next.datasets import (
+    Dataset,
+)
+from datalad_next.exceptions import CommandError
+from datalad_next.runners import iter_git_subproc
+
+from ._files import (
+    _BLOCK_SIZE,
+    _HashingReader,
+)
+
+
+lgr = logging.getLogger('datalad.mihextras.export_bagit')
+
+
+def _get_changed_files(repo, since, until):
+    """Yield ``(path, deleted)`` for all files changed between two commits
+
+    Paths are relative to the repository root, in POSIX convention.
+    Subdataset changes are not reported.
+    """
+    if not repo.commit_exists(since):
+        raise ValueError(f'Previously exported commit {since} not found')
+    diff = repo.call_git(
+        ['diff', '--raw', '--no-renames', '--no-abbrev', '-z', since, until])
+    items = diff.split('\0')
+    for spec, path in zip(items[::2], items[1::2]):
+        src_mode, dst_mode, src_sha, dst_sha, status = spec[1:].split(' ')
+        if '160000' in (src_mode, dst_mode):
+            # subdatasets are processed individually
+            continue
+        yield path, status == 'D'
+
+
+def _check_clean(repo):
+    """Raise ValueError if there are any unsaved changes in a repository
+
+    Only the repository itself is inspected, subdatasets are processed
+    individually.
+    """
+    # we only want to export a known state. A plain `git status` is much
+    # cheaper than a full `status`, and any output means trouble
+    if repo.call_git(
+            ['status', '--porcelain', '-z', '--untracked-files=normal',
+             '--ignore-submodules=all'],
+            read_only=True):
+        raise ValueError('Dataset has unsaved changes')
+
+
+def _iter_tree(repo, treeish, pathspec=None):
+    """Yield ``(mode, sha, size, path)`` for each file in a tree-ish
+
+    Sizes are those of the blobs, paths are relative to the repository
+    root, in POSIX convention. Subdatasets are not reported. With a
+    ``pathspec``, only files at or under these paths are reported.
+    """
+    for item in repo.call_git_items_(
+            ['ls-tree', '-r', '-l', '-z', '--full-tree', treeish]
+            + (['--'] + pathspec if pathspec else []),
+            sep='\0',
+            read_only=True):
+        spec, path = item.split('\t', maxsplit=1)
+        mode, objtype, sha, size = spec.split()
+        if objtype != 'blob':
+            # subdatasets are exported individually, if at all
+            continue
+        yield mode, sha, int(size), path
+
+
+def _join_annex_records(tree, records):
+    """Yield the items of `_iter_tree()`, each with its annex record
+
+    ``records`` are the JSON records of ``git annex find --branch`` for
+    the same tree, which reports files in the same order as
+    ``git ls-tree``, i.e., sorted by their path. Both are consumed in
+    lockstep, such that only a single record is held at a time. Files
+    without a record are reported with None instead.
+    """
+    records = iter(records)
+    rec = next(records, None)
+    for mode, sha, size, path in tree:
+        key = path.encode('utf-8')
+        while rec is not None and rec['file'].encode('utf-8') < key:
+            # not expected, but a record without a file cannot be used
+            lgr.debug('No file in tree for annex record %s', rec)
+            rec = next(records, None)
+        if rec is not None and rec['file'] == path:
+            yield mode, sha, size, path, rec
+            rec = next(records, None)
+        else:
+            yield mode, sha, size, path, None
+
+
+def _get_pathspec(ds, selection):
+    """Return the paths of a ``selection`` that concern a dataset
+
+    None is returned, if the dataset is at or under a selected path, or
+    without a ``selection``, i.e. if all of its files are selected.
+    Otherwise, the selected paths underneath the dataset are returned,
+    relative to its root, in POSIX convention.
+    """
+    if selection is None or any(
+            p == ds.pathobj or p in ds.pathobj.parents for p in selection):
+        return None
+    return [
+        p.relative_to(ds.pathobj).as_posix()
+        for p in selection
+        if ds.pathobj in p.parents
+    ]
+
+
+def _get_annex_path_match(pathspec):
+    """Return git-annex matching options for files at or under paths"""
+    if not pathspec:
+        return []
+    match = []
+    for path in pathspec:
+        # paths are matched literally
+        glob = re.sub(r'([*?[])', r'[\1]', path)
+        match += ['--or'] if match else []
+        match += [f'--include={glob}', '--or', f'--include={glob}/*']
+    return ['-('] + match + ['-)']
+
+
+def _iter_datasets(rootds, revision=None, recursion_limit=0, selection=None):
+    """Yield ``(dataset, commit, error)`` for all datasets to be exported
+
+    Without a ``revision``, the commit of a dataset is its checked-out
+    state. Otherwise, it is ``revision`` for the root dataset, and the
+    commit recorded in the exported commit of the superdataset for a
+    subdataset. Installed subdatasets are discovered in the exported
+    commit of their superdataset, down to ``recursion_limit`` levels
+    (None for no limit), and reported right after it.
+
+    With a ``selection`` of absolute paths, only subdatasets that contain
+    any of them, or are located underneath one, are reported.
+
+    If a dataset cannot be exported, ``commit`` is None and ``error`` is
+    a message on why. Its subdatasets are not reported then.
+    """
+    def walk(ds, commitish, level):
+        try:
+            commit = ds.repo.get_hexsha(commitish)
+            error = None if commit else 'No saved dataset state found'
+        except ValueError:
+            commit, error = None, f'Revision {commitish} not found'
+        yield ds, commit, error
+        if commit is None or level == recursion_limit:
+            return
+        for path, subcommit in _get_subdataset_commits(ds.repo, commit):
+            subds = Dataset(ds.pathobj / path)
+            if selection is not None and not any(
+                    p == subds.pathobj or p in subds.pathobj.parents
+                    or subds.pathobj in p.parents for p in selection):
+                continue
+            if subds.is_installed():
+                yield from walk(
+                    subds,
+                    None if revision is None else subcommit,
+                    level + 1,
+                )
+
+    yield from walk(rootds, revision, 0)
+
+
+def _get_subdataset_commits(repo, commit):
+    """Yield ``(path, commit)`` for each subdataset recorded in a commit
+
+    Paths are relative to the repository root, in POSIX convention.
+    """
+    try:
+        paths = [
+            item.split('\n', maxsplit=1)[1]
+            for item in repo.call_git_items_(
+                ['config', '-z', '--blob', f'{commit}:.gitmodules',
+                 '--get-regexp', r'^submodule\..*\.path$'],
+                sep='\0',
+                expect_fail=True,
+                read_only=True)
+        ]
+    except CommandError:
+        # no .gitmodules, no subdatasets
+        return
+    if not paths:
+        return
+    for item in repo.call_git_items_(
+            ['ls-tree', '-z', commit, '--'] + paths,
+            sep='\0',
+            read_only=True):
+        spec, path = item.split('\t', maxsplit=1)
+        mode, objtype, sha = spec.split()
+        if objtype == 'commit':
+            yield path, sha
+
+
+class _BoundedReader:
+    """Wrapper of a binary file object that reads no more than ``size`` bytes
+    """
+    def __init__(self, fileobj, size):
+        self._fileobj = fileobj
+        self._remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        chunk = self._fileobj.read(size)
+        self._remaining -= len(chunk)
+        return chunk
+
+
+class _ChunkReader:
+    """Binary file object interface to an iterable of byte chunks"""
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = bytearray()
+
+    def _fill(self, size=None, end=None):
+        """Read chunks until ``size`` bytes or ``end`` are buffered"""
+        while (size is None or len(self._buffer) < size) \
+                and (end is None or end not in self._buffer):
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                # no more output
+                break
+            self._buffer += chunk
+
+    def _take(self, size):
+        content = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return content
+
+    def read(self, size=-1):
+        self._fill(None if size < 0 else size)
+        return self._take(len(self._buffer) if size < 0 else size)
+
+    def readline(self):
+        self._fill(end=b'\n')
+        end = self._buffer.find(b'\n')
+        return self._take(len(self._buffer) if end < 0 else end + 1)
+
+
+class _GitBlobReader:
+    """Read blobs from a repository's object store
+
+    All blobs are read via a single ``git cat-file --batch`` process. If
+    reading a blob fails, the process is terminated, and no further blobs
+    can be read.
+    """
+    def __init__(self, repo):
+        # object names to request, None ends the process' input
+        self._requests = queue.Queue()
+        self._proc = iter_git_subproc(
+            # with the same configuration overrides as any other Git call
+            repo._git_cmd_prefix[1:] + ['cat-file', '--batch'],
+            input=iter(self._requests.get, None),
+            cwd=repo.pathobj,
+            # requests must not wait in a buffer, and output is processed
+            # as soon as it arrives
+            bufsize=0,
+        )
+        self._stdout = None
+
+    def __enter__(self):
+        self._stdout = _ChunkReader(self._proc.__enter__())
+        return self
+
+    def __exit__(self, *args):
+        self._close(*args)
+
+    def _close(self, *exc_info):
+        if self._stdout is None:
+            return
+        self._stdout = None
+        self._requests.put(None)
+        self._proc.__exit__(*exc_info)
+
+    def _request(self, name):
+        """Request an object, returns its size or None if it is not a blob
+        """
+        if self._stdout is None:
+            raise ValueError(f'Cannot read blob {name}, reader is closed')
+        self._requests.put(f'{name}\n'.encode('utf-8'))
+        header = self._stdout.readline().split()
+        if len(header) != 3:
+            # '<name> missing' or similar, no content follows
+            return None
+        size = int(header[2])
+        if header[1] != b'blob':
+            # skip the content of any other type of object
+            self._stdout.read(size + 1)
+            return None
+        return size
+
+    @contextmanager
+    def open(self, name):
+        """Yield the size of a blob, and a file object to read its content"""
+        size = self._request(name)
+        if size is None:
+            raise ValueError(f'Cannot read blob {name}')
+        reader = _BoundedReader(self._stdout, size)
+        try:
+            yield size, reader
+        except BaseException as e:
+            # the batch output is out of sync with the requests now
+            self._close(type(e), e, e.__traceback__)
+            raise
+        # skip any unread content, and the newline that terminates it
+        while reader.read(_BLOCK_SIZE):
+            pass
+        self._stdout.read(1)
+
+    def read(self, name):
+        """Return the content of a blob, or None if there is no such blob"""
+        size = self._request(name)
+        if size is None:
+            return None
+        content = self._stdout.read(size + 1)
+        return content[:-1]
+
+    def copy(self, sha, dst, algorithms):
+        """Write a blob to a file, returns its size and digests"""
+        with self.open(sha) as (size, src), open(dst, 'wb') as f:
+            reader = _HashingReader(src, algorithms)
+            copyfileobj(reader, f, _BLOCK_SIZE)
+        return size, reader.hexdigests()
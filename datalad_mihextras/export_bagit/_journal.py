@@ -0,0 +1,87 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Journal of the payload files placed into a bag, for resuming an export"""
+
+__docformat__ = 'restructuredtext'
+
+
+import json
+import logging
+import threading
+from pathlib import (
+    Path,
+)
+
+
+lgr = logging.getLogger('datalad.mihextras.export_bagit')
+
+# name of the tag file that records finished payload files while a bag is
+# built
+_journal_name = 'datalad-export-journal.jsonl'
+
+
+class _ExportJournal:
+    """Append-only record of the payload files placed into a bag
+
+    Each finished payload file is recorded as a JSON line with its
+    bag-relative path, size, modification time, and digests (if known).
+    With ``resume``, the records of a previous, interrupted export are
+    read and kept, otherwise any previous journal is discarded.
+    """
+    def __init__(self, bag_path, resume=False):
+        self._bag_path = Path(bag_path)
+        self._path = self._bag_path / _journal_name
+        self._done = {}
+        if resume and self._path.exists():
+            with self._path.open(encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        relpath, size, mtime, digests = json.loads(line)
+                    except ValueError:
+                        # a record that was not completely written
+                        continue
+                    self._done[relpath] = (size, mtime, digests)
+            lgr.info('Resume export, %i files in bag', len(self._done))
+        self._file = self._path.open(
+            'a' if resume else 'w', encoding='utf-8')
+        self._lock = threading.Lock()
+
+    def get(self, relpath, size):
+        """Return the recorded digests of a finished payload file
+
+        None is returned, if the file is not recorded, or its size or
+        modification time changed since.
+        """
+        rec = self._done.get(relpath)
+        if rec is None or rec[0] != size:
+            return None
+        try:
+            stat = (self._bag_path / relpath).stat()
+        except OSError:
+            return None
+        if (stat.st_size, stat.st_mtime_ns) != rec[:2]:
+            return None
+        return rec[2]
+
+    def get_paths(self):
+        """Return the paths of all payload files recorded before"""
+        return set(self._done)
+
+    def record(self, relpath, size, digests):
+        """Record a payload file as finished"""
+        mtime = (self._bag_path / relpath).stat().st_mtime_ns
+        line = json.dumps([relpath, size, mtime, digests])
+        with self._lock:
+            self._file.write(f'{line}\n')
+            self._file.flush()
+
+    def finish(self):
+        """Close and remove the journal"""
+        self._file.close()
+        self._path.unlink()
@@ -0,0 +1,302 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Enumerate and plan the payload of a bag"""
+
+__docformat__ = 'restructuredtext'
+
+
+from contextlib import (
+    nullcontext,
+)
+from itertools import chain
+from pathlib import (
+    Path,
+)
+from shutil import (
+    disk_usage,
+)
+
+from datalad.utils import (
+    bytes2human,
+)
+
+from datalad_next.commands import (
+    get_status_dict,
+)
+
+from ._annex import (
+    _find_directory_remote_object,
+    _get_directory_remotes,
+    _get_key_digest,
+    _key_url_lookup,
+)
+from ._git import (
+    _check_clean,
+    _get_annex_path_match,
+    _get_pathspec,
+    _iter_tree,
+    _join_annex_records,
+)
+
+
+# number of changed files queried from Git and git-annex at once, to keep
+# command lines short
+_PATHS_BATCH_SIZE = 256
+
+
+def _iter_payload(rootds, ds, treeish, paths=None, worktree=True,
+                  file_urls=False, remote_only=False, selection=None,
+                  annex_match=None, merge=True):
+    """Yield a record for each file of a dataset that is to be exported
+
+    The files are enumerated from the committed ``treeish``. With
+    ``worktree``, file content is read from the worktree, which must be
+    clean (see `_check_clean()`). Otherwise, content is read from Git's
+    object store and the annex.
+
+    Records are dicts with the file's ``path``, the ``bag_relpath`` of the
+    file in the bag (in POSIX convention), and its ``bytesize``. The
+    ``source`` is the file to read the content from, or ``blob`` is the
+    SHA of a Git blob with the content. For annex'ed files, the ``key``,
+    a usable ``key_digest`` (see `_get_key_digest()`), and the path of the
+    ``annex_object`` (if the file is a symlink to it, or without
+    ``worktree``) are included. The ``bytesize`` is None, if it is neither
+    recorded in the key, nor is the content present. If the file can be
+    registered as a remote file, ``url`` is the URL to register it with.
+    With ``file_urls``, this includes file:// URLs of content in a
+    directory special remote. Otherwise, ``present`` tells whether the
+    file's content is locally available from the ``source``, which may
+    also be a file in a directory special remote. Such content is
+    ``unverified``, and must be checked against the ``key_digest``.
+    With ``remote_only``, a ValueError is raised for the first annex'ed
+    file that cannot be registered as a remote file.
+
+    If ``paths`` is given, only files at these paths (relative to the
+    dataset root, in POSIX convention) are reported. A ``selection`` of
+    absolute paths limits the reported files to those at or under any of
+    them, and only annex'ed files matching the git-annex matching options
+    in ``annex_match`` are reported. All of them are passed on to the Git
+    and git-annex queries (``paths`` in batches), such that other files
+    are never looked at.
+
+    ``merge`` is passed on to `_key_url_lookup()`.
+    """
+    repo = ds.repo
+    has_annex = hasattr(repo, 'call_annex')
+    pathspec = _get_pathspec(ds, selection)
+    if pathspec == []:
+        # nothing selected in this dataset
+        return
+
+    if paths is not None:
+        # only the given files are queried, in batches
+        paths = sorted(
+            p for p in paths
+            if pathspec is None
+            or any(p == s or p.startswith(f'{s}/') for s in pathspec))
+        pathspecs = [
+            paths[i:i + _PATHS_BATCH_SIZE]
+            for i in range(0, len(paths), _PATHS_BATCH_SIZE)
+        ]
+        paths = set(paths)
+    else:
+        pathspecs = [pathspec]
+
+    def iter_files():
+        for spec in pathspecs:
+            # a single batch query for all annex'ed files, no matter
+            # whether their content is present or not, processed while the
+            # tree is walked
+            annex_records = repo._call_annex_records_items_(
+                ['find', '--anything', f'--branch={treeish}']
+                + _get_annex_path_match(spec)
+                + (annex_match or [])) if has_annex else ()
+            yield from _join_annex_records(
+                _iter_tree(repo, treeish, spec), annex_records)
+
+    objects_path = Path(repo.dot_git, 'annex', 'objects')
+    hashdir = 'hashdirlower' \
+        if repo.config.getbool('annex', 'tune.objecthashlower', False) \
+        else 'hashdirmixed'
+
+    ds_relpath = ds.pathobj.relative_to(rootds.pathobj).as_posix()
+    # directory special remotes, determined on first need
+    remote_dirs = None
+
+    def find_remote_object(key, hashdir):
+        nonlocal remote_dirs
+        if remote_dirs is None:
+            remote_dirs = _get_directory_remotes(repo)
+        return _find_directory_remote_object(remote_dirs, key, hashdir)
+
+    # URLs are looked up as needed
+    with _key_url_lookup(repo, merge=merge) if has_annex \
+            else nullcontext(lambda key: None) as get_url:
+        for mode, sha, size, path, rec in iter_files():
+            if paths is not None and path not in paths:
+                # under a changed path, but not changed itself
+                continue
+            if annex_match and rec is None:
+                # files in Git, or not matching
+                continue
+            filepath = ds.pathobj / path
+            rec = rec or {}
+            key = rec.get('key')
+            key_digest = _get_key_digest(
+                rec.get('backend'), rec.get('keyname'))
+            key_object = objects_path / rec[hashdir] / key / key \
+                if key else None
+            # for annex'ed files, link to the object in the annex directly,
+            # not to the symlink pointing to it
+            annex_object = key_object \
+                if mode == '120000' or not worktree else None
+            source = annex_object if not worktree else filepath
+            if key:
+                # annex'ed files report their size in the key, if at all
+                size = int(rec['bytesize']) \
+                    if rec.get('bytesize', 'unknown') != 'unknown' else None
+            elif worktree:
+                # Git filters may make the content in the worktree differ
+                # from the blob, and the blob of a symlink in git is its
+                # target, not the content
+                size = None
+            # only a key with digest and size info, and an associated URL can
+            # be a remote file
+            url = get_url(key) \
+                if key_digest and size is not None else None
+            # only content that is to be placed into the bag must be present
+            present = bool(url) or not key or key_object.exists()
+            unverified = False
+            if key and not url and (file_urls or not present):
+                remote_object = find_remote_object(key, rec['hashdirlower'])
+                if remote_object and file_urls and key_digest \
+                        and size is not None:
+                    url = remote_object.as_uri()
+                    present = True
+                elif remote_object and not present:
+                    # read content from a directory special remote directly,
+                    # rather than obtaining it into the annex first, which
+                    # would have verified it
+                    source, annex_object, present = remote_object, None, True
+                    unverified = bool(key_digest)
+            if remote_only and key and not url:
+                raise ValueError(
+                    f'No URL to register {filepath} as a remote file with')
+            if size is None and present:
+                size = source.stat().st_size
+            # bagit always used relative path in POSIX convention
+            relpath = path if ds_relpath == '.' else f'{ds_relpath}/{path}'
+            yield dict(
+                path=filepath,
+                bag_relpath=f'data/{relpath}',
+                bytesize=size,
+                source=source,
+                blob=sha if not (key or worktree) else None,
+                key=key,
+                key_digest=key_digest,
+                url=url,
+                annex_object=annex_object,
+                present=present,
+                unverified=unverified,
+            )
+
+
+def _plan_export(rootds, datasets, target, worktree, res_kwargs,
+                 get_missing=False, file_urls=False, remote_only=False,
+                 selection=None, annex_match=None):
+    """Yield a plan of exporting ``datasets``, without exporting anything
+
+    For each dataset, the number and size of files to be placed into the
+    bag, to be registered as remote files, and of files without available
+    content are reported, as `_iter_payload()` determines them. A final
+    result reports the predicted Payload-Oxum of the bag, and is
+    'impossible' if there is not enough free space at the ``target``
+    directory for all files to be placed into the bag. Without a
+    ``target``, free space is not checked.
+    """
+    total_bytes = total_files = local_bytes = 0
+    for d, commit, error in datasets:
+        # [files, bytes]
+        local = [0, 0]
+        remote = [0, 0]
+        unavailable = 0
+        try:
+            if worktree and not error:
+                _check_clean(d.repo)
+            items = [] if error else _iter_payload(
+                rootds, d, commit, worktree=worktree,
+                file_urls=file_urls, remote_only=remote_only,
+                selection=selection, annex_match=annex_match,
+                # a plan does not modify any repository
+                merge=False)
+            for item in items:
+                if item['url']:
+                    counts = remote
+                elif item['present'] or (
+                        get_missing and item['bytesize'] is not None):
+                    counts = local
+                else:
+                    unavailable += 1
+                    continue
+                counts[0] += 1
+                counts[1] += item['bytesize']
+        except ValueError as e:
+            error = str(e)
+        if error:
+            yield get_status_dict(
+                ds=d,
+                status='error',
+                message=error,
+                **res_kwargs)
+            continue
+        total_files += local[0] + remote[0]
+        total_bytes += local[1] + remote[1]
+        local_bytes += local[1]
+        yield get_status_dict(
+            ds=d,
+            status='ok',
+            type='dataset',
+            message=('%i files (%s) to place into the bag, %i files (%s) '
+                     'to register as remote files, %i files without '
+                     'available content',
+                     local[0], bytes2human(local[1]),
+                     remote[0], bytes2human(remote[1]),
+                     unavailable),
+            local_files=local[0],
+            local_bytes=local[1],
+            remote_files=remote[0],
+            remote_bytes=remote[1],
+            unavailable_files=unavailable,
+            **res_kwargs)
+
+    free_bytes = None
+    if target is not None:
+        # the target directory may not exist yet
+        target = Path(target).absolute()
+        free_bytes = disk_usage(next(
+            p for p in chain([target], target.parents) if p.exists())).free
+    res = dict(
+        ds=rootds,
+        type='bag',
+        payload_oxum=f'{total_bytes}.{total_files}',
+        free_bytes=free_bytes,
+        **res_kwargs)
+    if free_bytes is not None and free_bytes < local_bytes:
+        yield get_status_dict(
+            status='impossible',
+            message=('not enough free space at %s, %s needed, %s available',
+                     target, bytes2human(local_bytes),
+                     bytes2human(free_bytes)),
+            **res)
+    else:
+        yield get_status_dict(
+            status='ok',
+            message=('predicted Payload-Oxum %s, %s to place into the bag',
+                     res['payload_oxum'], bytes2human(local_bytes)),
+            **res)
@@ -0,0 +1,126 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Local object store of exported file content"""
+
+__docformat__ = 'restructuredtext'
+
+
+import hashlib
+import logging
+import os
+import threading
+from pathlib import (
+    Path,
+)
+
+from ._annex import (
+    _get_key_file,
+)
+from ._files import (
+    _place_file,
+)
+
+
+lgr = logging.getLogger('datalad.mihextras.export_bagit')
+
+
+class _ObjectStore:
+    """Local content-addressed store of annex key content
+
+    Each key's content is held in a read-only file, named after the key,
+    in the same directory hierarchy git-annex uses for its objects. The
+    modification time of an empty file at the same location in a separate
+    ``.used`` directory records when the content was last used. Objects
+    may be hardlinked into bags, their own modification time must not
+    change.
+    """
+    def __init__(self, path, size_limit=None):
+        self._path = Path(path)
+        self._used_path = self._path / '.used'
+        self._size_limit = size_limit
+
+    def _get_path(self, key, root=None):
+        hashdir = hashlib.md5(key.encode('utf-8')).hexdigest()
+        return (root or self._path) / hashdir[:3] / hashdir[3:6] \
+            / _get_key_file(key)
+
+    def __contains__(self, key):
+        return self._get_path(key).exists()
+
+    def place(self, key, src, dst, link_mode, annex_object=None,
+              algorithms=None):
+        """Place the content of a key into a bag via the store
+
+        Content that is not yet in the store is copied into it first (see
+        `_place_file()`), but never hardlinked, as the store must not
+        share files with a dataset. From the store, content is placed into
+        the bag according to ``link_mode``, like from an annex object.
+
+        Returns the same as `_place_file()`. Digests are only reported for
+        content that was copied into the store.
+        """
+        obj = self._get_path(key)
+        digests = {}
+        if not obj.exists():
+            obj.parent.mkdir(exist_ok=True, parents=True)
+            # concurrent exports could place the same key, a file appears
+            # in the store only once it is complete
+            tmp = obj.with_name(
+                f'{obj.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+            _, digests = _place_file(
+                annex_object or src,
+                tmp,
+                'reflink' if link_mode in ('reflink', 'auto') else 'copy',
+                algorithms=algorithms,
+            )
+            os.chmod(tmp, 0o444)
+            os.replace(tmp, obj)
+        # record the use of the content
+        used = self._get_path(key, self._used_path)
+        used.parent.mkdir(exist_ok=True, parents=True)
+        used.touch()
+        method, _ = _place_file(obj, dst, link_mode, annex_object=obj)
+        return method, digests
+
+    def discard(self, key):
+        """Remove the content of a key from the store, if it is there"""
+        for path in (self._get_path(key),
+                     self._get_path(key, self._used_path)):
+            if path.exists():
+                path.unlink()
+
+    def evict(self):
+        """Remove least recently used content beyond the size limit"""
+        if self._size_limit is None or not self._path.exists():
+            return
+        objects = []
+        for root, dirs, files in os.walk(self._path):
+            if Path(root) == self._path and '.used' in dirs:
+                # usage records are no content
+                dirs.remove('.used')
+            for name in files:
+                if name.endswith('.tmp'):
+                    # possibly still being written
+                    continue
+                path = Path(root, name)
+                used = self._used_path / path.relative_to(self._path)
+                stat = path.stat()
+                mtime = stat.st_mtime
+                if used.exists():
+                    mtime = max(mtime, used.stat().st_mtime)
+                objects.append((mtime, stat.st_size, path, used))
+        total = sum(size for mtime, size, path, used in objects)
+        for mtime, size, path, used in sorted(objects):
+            if total <= self._size_limit:
+                break
+            lgr.debug('Remove %s from object store', path.name)
+            path.unlink()
+            if used.exists():
+                used.unlink()
+            total -= size
@@ -0,0 +1,349 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Write a bag as an archive stream"""
+
+__docformat__ = 'restructuredtext'
+
+
+import hashlib
+import logging
+import os
+import sys
+import tarfile
+import time
+import zipfile
+from contextlib import (
+    contextmanager,
+    nullcontext,
+)
+from io import BytesIO
+from shutil import (
+    copyfileobj,
+)
+
+from datalad_next.commands import (
+    get_status_dict,
+)
+
+from ._bag import (
+    _export_commit_tag,
+    _get_fetch,
+    _get_manifests,
+    _get_new_bag_config,
+    _get_tag_file,
+)
+from ._files import (
+    _BLOCK_SIZE,
+    _HashingReader,
+    _matches_key_digest,
+)
+from ._git import (
+    _check_clean,
+    _GitBlobReader,
+)
+from ._payload import (
+    _iter_payload,
+)
+
+
+lgr = logging.getLogger('datalad.mihextras.export_bagit')
+
+
+def _stream_bag(rootds, datasets, to, archive, worktree, res_kwargs,
+                file_urls=False, remote_only=False, selection=None,
+                annex_match=None):
+    """Write a bag of all ``datasets`` directly into an archive
+
+    Payload files are written to the archive one by one, while they are
+    hashed, tag files and manifests are written at the end. With ``to``
+    being '-', the archive is written to stdout, otherwise to ``to`` with
+    the archive format as extension. ``datasets`` are reported by
+    `_iter_datasets()`, ``worktree`` and all other options are passed on
+    to `_iter_payload()`.
+    """
+    from bdbag.bdbagit import make_remote_file_entry
+
+    if str(to) == '-':
+        bag_name = rootds.pathobj.name
+        archive_path = '-'
+        output = _stdout_stream()
+    else:
+        bag_name = to.name
+        archive_path = to.parent / f'{to.name}.{archive}'
+        archive_path.parent.mkdir(exist_ok=True, parents=True)
+        output = archive_path.open('wb')
+
+    bagit_txt, bag_info, algorithms = _get_new_bag_config()
+    payload = {}
+    remote_entries = {}
+    commits = {}
+    # bag-relative path of the first file with the content of an annex key
+    key_paths = {}
+    with _remove_on_failure(archive_path), output as stream, (
+            _ZipStream(stream) if archive == 'zip'
+            else _TarStream(stream, archive)) as writer:
+        writer.add_bytes(f'{bag_name}/bagit.txt', bagit_txt.encode('utf-8'))
+        for d, commit, error in datasets:
+            if worktree and not error:
+                try:
+                    _check_clean(d.repo)
+                except ValueError as e:
+                    error = str(e)
+            if error:
+                yield get_status_dict(
+                    ds=d,
+                    status='error',
+                    message=error,
+                    **res_kwargs)
+                continue
+            try:
+                with nullcontext() if worktree else _GitBlobReader(d.repo) \
+                        as blobs:
+                    for item in _iter_payload(
+                            rootds, d, commit, worktree=worktree,
+                            file_urls=file_urls, remote_only=remote_only,
+                            selection=selection, annex_match=annex_match):
+                        bag_relpath = item['bag_relpath']
+                        key_digest = item['key_digest']
+                        name = f'{bag_name}/{bag_relpath}'
+                        if item['url']:
+                            make_remote_file_entry(
+                                remote_entries,
+                                bag_relpath,
+                                item['url'],
+                                item['bytesize'],
+                                *key_digest,
+                            )
+                            message = 'registered as a remote file'
+                        elif item['blob']:
+                            with blobs.open(item['blob']) as (size, f):
+                                payload[bag_relpath] = (
+                                    size,
+                                    writer.add_stream(
+                                        name, f, size, algorithms),
+                                )
+                            message = 'added to archive'
+                        elif item['key'] in key_paths \
+                                and hasattr(writer, 'add_link'):
+                            # identical content is in the archive already
+                            src_relpath = key_paths[item['key']]
+                            writer.add_link(
+                                name, f'{bag_name}/{src_relpath}')
+                            payload[bag_relpath] = payload[src_relpath]
+                            message = 'linked in archive'
+                        elif not item['present']:
+                            yield get_status_dict(
+                                ds=d,
+                                status='impossible',
+                                path=str(item['path']),
+                                type='file',
+                                message='file content not available locally',
+                                **res_kwargs)
+                            continue
+                        elif item['unverified'] and not _matches_key_digest(
+                                item['source'], key_digest):
+                            # checked before anything goes into the archive
+                            yield get_status_dict(
+                                ds=d,
+                                status='error',
+                                path=str(item['path']),
+                                type='file',
+                                message=('invalid file content: %s',
+                                         f'{key_digest[0]} checksum '
+                                         f'mismatch of {item["source"]}'),
+                                **res_kwargs)
+                            continue
+                        else:
+                            # a key digest saves us from hashing the file
+                            size, digests = writer.add_file(
+                                name,
+                                item['source'],
+                                [] if key_digest else algorithms,
+                            )
+                            payload[bag_relpath] = (
+                                size, digests or dict([key_digest]))
+                            if item['key']:
+                                key_paths.setdefault(
+                                    item['key'], bag_relpath)
+                            message = 'added to archive'
+                        yield get_status_dict(
+                            ds=d,
+                            status='ok',
+                            path=str(item['path']),
+                            type='file',
+                            message=message,
+                            **res_kwargs)
+            except ValueError as e:
+                # the archive only holds the files added until then
+                yield get_status_dict(
+                    ds=d,
+                    status='error',
+                    message=str(e),
+                    **res_kwargs)
+                continue
+            commits[d.pathobj.relative_to(rootds.pathobj).as_posix()] = commit
+            yield get_status_dict(ds=d, status='ok', **res_kwargs)
+
+        manifests, bag_info['Payload-Oxum'] = _get_manifests(
+            payload, remote_entries, algorithms)
+        bag_info[_export_commit_tag] = [
+            f'{commit} {ds_relpath}'
+            for ds_relpath, commit in sorted(commits.items())
+        ]
+        tag_files = {
+            f'manifest-{alg}.txt': content
+            for alg, content in manifests.items()
+        }
+        if remote_entries:
+            tag_files['fetch.txt'] = _get_fetch(remote_entries)
+        tag_files['bag-info.txt'] = _get_tag_file(bag_info)
+        for name, content in tag_files.items():
+            writer.add_bytes(f'{bag_name}/{name}', content.encode('utf-8'))
+        tag_files['bagit.txt'] = bagit_txt
+        for alg in manifests:
+            writer.add_bytes(
+                f'{bag_name}/tagmanifest-{alg}.txt',
+                ''.join(
+                    f'{hashlib.new(alg, content.encode("utf-8")).hexdigest()}'
+                    f' {name}\n'
+                    for name, content in sorted(tag_files.items())
+                ).encode('utf-8'),
+            )
+    yield get_status_dict(
+        status='ok',
+        type='bag',
+        path=str(archive_path),
+        **res_kwargs)
+
+
+class _TarStream:
+    """Sequentially write files into a (compressed) TAR archive stream"""
+    def __init__(self, fileobj, archive):
+        self._tar = tarfile.open(
+            fileobj=fileobj,
+            mode={'tar': 'w|', 'tgz': 'w|gz', 'bz2': 'w|bz2'}[archive],
+        )
+        # read larger blocks than the 16k default when adding files
+        self._tar.copybufsize = _BLOCK_SIZE
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self._tar.close()
+
+    def add_bytes(self, name, content):
+        info = tarfile.TarInfo(name)
+        info.size = len(content)
+        info.mtime = time.time()
+        info.mode = 0o644
+        with BytesIO(content) as f:
+            self._tar.addfile(info, f)
+
+    def add_file(self, name, path, algorithms):
+        """Add a file, returns its size and digests"""
+        stat = os.stat(path)
+        with open(path, 'rb') as f:
+            digests = self.add_stream(
+                name, f, stat.st_size, algorithms, stat.st_mtime)
+        return stat.st_size, digests
+
+    def add_stream(self, name, fileobj, size, algorithms, mtime=None):
+        """Add ``size`` bytes read from a file object, returns the digests"""
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = time.time() if mtime is None else mtime
+        info.mode = 0o644
+        reader = _HashingReader(fileobj, algorithms)
+        self._tar.addfile(info, reader)
+        return reader.hexdigests()
+
+    def add_link(self, name, target):
+        """Add a hardlink to a file that was added before"""
+        info = tarfile.TarInfo(name)
+        info.type = tarfile.LNKTYPE
+        info.linkname = target
+        info.mtime = time.time()
+        info.mode = 0o644
+        self._tar.addfile(info)
+
+
+class _ZipStream:
+    """Sequentially write files into a ZIP archive stream"""
+    def __init__(self, fileobj):
+        self._zip = zipfile.ZipFile(
+            fileobj, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self._zip.close()
+
+    def _get_info(self, name, mtime):
+        info = zipfile.ZipInfo(name, time.localtime(mtime)[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.external_attr = 0o644 << 16
+        return info
+
+    def add_bytes(self, name, content):
+        self._zip.writestr(self._get_info(name, time.time()), content)
+
+    def add_file(self, name, path, algorithms):
+        """Add a file, returns its size and digests"""
+        stat = os.stat(path)
+        with open(path, 'rb') as f:
+            digests = self.add_stream(
+                name, f, stat.st_size, algorithms, stat.st_mtime)
+        return stat.st_size, digests
+
+    def add_stream(self, name, fileobj, size, algorithms, mtime=None):
+        """Add ``size`` bytes read from a file object, returns the digests"""
+        with self._zip.open(
+                self._get_info(name, time.time() if mtime is None else mtime),
+                'w',
+                force_zip64=size >= zipfile.ZIP64_LIMIT) as dst:
+            reader = _HashingReader(fileobj, algorithms)
+            copyfileobj(reader, dst, _BLOCK_SIZE)
+        return reader.hexdigests()
+
+
+@contextmanager
+def _stdout_stream():
+    """Provide a binary stream to stdout, and divert all other output
+
+    For as long as the context is active, anything else written to stdout
+    (e.g., result rendering) goes to stderr instead, to not corrupt the
+    stream.
+    """
+    sys.stdout.flush()
+    stdout_fd = os.dup(1)
+    os.dup2(2, 1)
+    try:
+        with os.fdopen(stdout_fd, 'wb', closefd=False) as stream:
+            yield stream
+    finally:
+        sys.stdout.flush()
+        os.dup2(stdout_fd, 1)
+        os.close(stdout_fd)
+
+
+@contextmanager
+def _remove_on_failure(path):
+    """Remove the file at ``path``, if the context is left with an exception
+
+    A ``path`` of '-' (stdout) is never removed.
+    """
+    try:
+        yield
+    except BaseException:
+        if path != '-' and path.exists():
+            lgr.debug('Remove incomplete %s', path)
+            path.unlink()
+        raise
@@ -1,7 +1,29 @@
-from datalad.api import x_export_bagit
+import hashlib
+import tarfile
+import zipfile
+from io import BytesIO
+from pathlib import Path
 
+import pytest
+
+from datalad.api import (
+    clone,
+    x_export_bagit,
+)
+
+from datalad_next.exceptions import CommandError
 from datalad_next.runners import call_git_success
 
+from datalad_mihextras.export_bagit import (
+    _annex,
+    _directory,
+    _files,
+    _git,
+    _journal,
+    _payload,
+    _stream,
+)
+
 
 def test_export_bagit(no_result_rendering, existing_dataset, tmp_path):
     ds = existing_dataset
@@ -21,3 +43,937 @@ def test_export_bagit(no_result_rendering, existing_dataset, tmp_path):
     assert (tmp_path / 'bagit.txt').exists()
     assert 'datalad/config' in (tmp_path / 'manifest-md5.txt').read_text()
     assert fileurl in (tmp_path / 'fetch.txt').read_text()
+
+
+def test_export_bagit_jobs(no_result_rendering, existing_dataset, tmp_path):
+    ds = existing_dataset
+    sizes = dict(small=10, medium=1000, large=100000)
+    for name, size in sizes.items():
+        (ds.pathobj / name).write_bytes(b'x' * size)
+    (ds.pathobj / 'ingit.txt').write_text('in git')
+    ds.save(to_git=False)
+    ds.save(path='ingit.txt', to_git=True)
+    res = ds.x_export_bagit(tmp_path, jobs=2)
+    copied = [r for r in res if r.get('message') == 'copied into bag']
+    # one result per copied file
+    assert set(Path(r['path']).name for r in copied) >= set(sizes)
+    for name, size in sizes.items():
+        assert (tmp_path / 'data' / name).read_bytes() == b'x' * size
+    assert 'data/large' in (tmp_path / 'manifest-md5.txt').read_text()
+
+
+def test_export_bagit_dataset_jobs(no_result_rendering, existing_dataset,
+                                   tmp_path):
+    ds = existing_dataset
+    for name in ('sub1', 'sub2', 'sub1/subsub'):
+        sub = ds.create(name)
+        (sub.pathobj / 'local.txt').write_text(f'local {name}')
+        (sub.pathobj / 'remote.txt').write_text(f'remote {name}')
+        sub.save(to_git=False)
+        call_git_success(
+            ['annex', 'registerurl',
+             sub.repo.get_file_annexinfo('remote.txt')['key'],
+             f'http://example.com/{name}'],
+            cwd=sub.pathobj,
+            capture_output=True,
+        )
+    ds.save(recursive=True)
+    ds.x_export_bagit(tmp_path / 'serial', recursive=True)
+    res = ds.x_export_bagit(
+        tmp_path / 'parallel', recursive=True, dataset_jobs=3)
+    assert len([r for r in res if r['type'] == 'dataset']) == 4
+    for name in ('manifest-md5.txt', 'manifest-sha256.txt', 'fetch.txt'):
+        assert (tmp_path / 'serial' / name).read_text() \
+            == (tmp_path / 'parallel' / name).read_text()
+    assert 'http://example.com/sub1/subsub' \
+        in (tmp_path / 'parallel' / 'fetch.txt').read_text()
+
+
+def test_export_bagit_iter_datasets(no_result_rendering, existing_dataset):
+    ds = existing_dataset
+    sub1 = ds.create('sub1')
+    ds.repo.tag('v1')
+    sub1_v1 = sub1.repo.get_hexsha()
+    ds.create('sub1/subsub')
+    ds.create('sub2')
+    ds.save(recursive=True)
+    ds.drop('sub2', what='all', reckless='kill', recursive=True)
+
+    def relpaths(*args):
+        return [
+            (d.pathobj.relative_to(ds.pathobj).as_posix(), commit)
+            for d, commit, error in _git._iter_datasets(ds, *args)
+        ]
+
+    # uninstalled subdatasets are not reported
+    assert [p for p, c in relpaths(None, None)] \
+        == ['.', 'sub1', 'sub1/subsub']
+    assert [p for p, c in relpaths(None, 1)] == ['.', 'sub1']
+    assert relpaths(None, 0) == [('.', ds.repo.get_hexsha())]
+    # with a revision, subdatasets are reported in their recorded state
+    assert relpaths('v1', None) \
+        == [('.', ds.repo.get_hexsha('v1')), ('sub1', sub1_v1)]
+    assert list(_git._iter_datasets(ds, 'bogus')) \
+        == [(ds, None, 'Revision bogus not found')]
+
+
+def test_export_bagit_bag_of_bags(no_result_rendering, existing_dataset,
+                                  tmp_path):
+    ds = existing_dataset
+    for name in ('sub1', 'sub2'):
+        sub = ds.create(name)
+        (sub.pathobj / 'file.txt').write_text(name)
+        sub.save()
+    ds.save(recursive=True)
+    bag_path = tmp_path / 'bag'
+    ds.x_export_bagit(
+        bag_path, recursive=True, bag_of_bags=True, dataset_jobs=2)
+    md5 = (bag_path / 'manifest-md5.txt').read_text()
+    for name in ('sub1', 'sub2'):
+        assert f'data/{name}.zip' in md5
+        assert f'data/{name}/' not in md5
+        with zipfile.ZipFile(bag_path / 'data' / f'{name}.zip') as z:
+            assert z.read(f'{name}/data/file.txt') == name.encode()
+    # only the bag of a changed subdataset is rebuilt
+    (ds.pathobj / 'sub2' / 'file.txt').unlink()
+    (ds.pathobj / 'sub2' / 'file.txt').write_text('changed')
+    ds.save(recursive=True)
+    res = ds.x_export_bagit(
+        bag_path, recursive=True, bag_of_bags=True, update=True)
+    assert [r['status'] for r in res
+            if r['path'] == str(ds.pathobj / 'sub1')] == ['notneeded']
+    with zipfile.ZipFile(bag_path / 'data' / 'sub2.zip') as z:
+        assert z.read('sub2/data/file.txt') == b'changed'
+    assert (bag_path / 'manifest-md5.txt').read_text() != md5
+
+
+def test_export_bagit_get_missing(no_result_rendering, existing_dataset,
+                                  tmp_path):
+    ds = existing_dataset
+    for name in ('one', 'two', 'three'):
+        (ds.pathobj / name).write_text(name)
+    (ds.pathobj / 'same').write_text('one')
+    ds.save(to_git=False)
+    cl = clone(source=ds.path, path=tmp_path / 'clone')
+    res = cl.x_export_bagit(tmp_path / 'incomplete', on_failure='ignore')
+    assert set(Path(r['path']).name for r in res
+               if r['status'] == 'impossible') \
+        == {'one', 'two', 'three', 'same'}
+    assert not (tmp_path / 'incomplete' / 'data' / 'one').exists()
+    cl.get('one')
+    res = cl.x_export_bagit(tmp_path / 'bag', get_missing=True,
+                            drop_fetched=True, jobs=2)
+    for name in ('one', 'two', 'three'):
+        assert (tmp_path / 'bag' / 'data' / name).read_text() == name
+    assert (tmp_path / 'bag' / 'data' / 'same').read_text() == 'one'
+    # only fetched content is dropped again
+    assert cl.repo.file_has_content(['one', 'two', 'three']) \
+        == [True, False, False]
+
+
+def test_export_bagit_get_missing_failed(no_result_rendering,
+                                         existing_dataset, tmp_path):
+    ds = existing_dataset
+    for name, content in (('one', 'one'), ('two', 'two'), ('twin', 'two')):
+        (ds.pathobj / name).write_text(content)
+    ds.save(to_git=False)
+    cl = clone(source=ds.path, path=tmp_path / 'clone')
+    # the content of 'two' is nowhere to be found
+    call_git_success(['annex', 'drop', '--force', 'two'], cwd=ds.pathobj,
+                     capture_output=True)
+    res = cl.x_export_bagit(tmp_path / 'bag', get_missing=True,
+                            on_failure='ignore')
+    assert {Path(r['path']).name for r in res if r['status'] == 'error'} \
+        == {'two', 'twin'}
+    # the rest of the export completed
+    assert (tmp_path / 'bag' / 'data' / 'one').read_text() == 'one'
+    assert not (tmp_path / 'bag' / 'data' / 'two').exists()
+    md5 = (tmp_path / 'bag' / 'manifest-md5.txt').read_text()
+    assert 'data/one' in md5
+    assert 'data/two' not in md5
+    assert 'data/twin' not in md5
+
+
+def test_export_bagit_directory_remote(no_result_rendering,
+                                      existing_dataset, tmp_path):
+    ds = existing_dataset
+    (ds.pathobj / 'stored.txt').write_text('stored')
+    ds.save(to_git=False)
+    store = tmp_path / 'store'
+    store.mkdir()
+    for args in (['initremote', 'store', 'type=directory',
+                  f'directory={store}', 'encryption=none'],
+                 ['copy', '--to', 'store', 'stored.txt'],
+                 ['drop', 'stored.txt']):
+        call_git_success(['annex'] + args, cwd=ds.pathobj,
+                         capture_output=True)
+    ds.x_export_bagit(tmp_path / 'bag')
+    assert (tmp_path / 'bag' / 'data' / 'stored.txt').read_text() \
+        == 'stored'
+    # the content was not obtained into the dataset
+    assert ds.repo.file_has_content(['stored.txt']) == [False]
+    # or the file is registered with its location in the remote
+    ds.x_export_bagit(tmp_path / 'filebag', file_urls=True)
+    assert not (tmp_path / 'filebag' / 'data' / 'stored.txt').exists()
+    fetch = (tmp_path / 'filebag' / 'fetch.txt').read_text().split()
+    assert fetch[0].startswith(store.as_uri() + '/')
+    assert fetch[1:] == ['6', 'data/stored.txt']
+
+
+def test_export_bagit_directory_remote_corrupt(no_result_rendering,
+                                              existing_dataset, tmp_path):
+    ds = existing_dataset
+    for name in ('stored.txt', 'other.txt'):
+        (ds.pathobj / name).write_text(name)
+    ds.save(to_git=False)
+    store = tmp_path / 'store'
+    store.mkdir()
+    for args in (['initremote', 'store', 'type=directory',
+                  f'directory={store}', 'encryption=none'],
+                 ['move', '--to', 'store', '.']):
+        call_git_success(['annex'] + args, cwd=ds.pathobj,
+                         capture_output=True)
+    key = ds.repo.get_file_annexinfo('stored.txt')['key']
+    obj = next(p for p in store.rglob(key) if p.is_file())
+    obj.chmod(0o644)
+    obj.write_text('STORED.txt')
+    for kwargs in ({}, dict(archive='tar', stream=True)):
+        res = ds.x_export_bagit(tmp_path / 'bag', on_failure='ignore',
+                                **kwargs)
+        assert [Path(r['path']).name for r in res
+                if r['status'] == 'error'] == ['stored.txt']
+    assert (tmp_path / 'bag' / 'data' / 'other.txt').read_text() \
+        == 'other.txt'
+    assert not (tmp_path / 'bag' / 'data' / 'stored.txt').exists()
+    assert 'stored.txt' \
+        not in (tmp_path / 'bag' / 'manifest-md5.txt').read_text()
+    with tarfile.open(tmp_path / 'bag.tar') as tar:
+        assert 'bag/data/stored.txt' not in tar.getnames()
+
+
+def test_export_bagit_link_mode(no_result_rendering, existing_dataset,
+                                tmp_path):
+    ds = existing_dataset
+    (ds.pathobj / 'annexed').write_text('annexed content')
+    ds.save(to_git=False)
+    annex_object = (ds.pathobj / 'annexed').resolve()
+    bag_path = tmp_path / 'bag'
+    res = ds.x_export_bagit(bag_path, link_mode='hardlink')
+    assert any(r.get('message') == 'hardlinked into bag' for r in res)
+    assert (bag_path / 'data' / 'annexed').stat().st_ino \
+        == annex_object.stat().st_ino
+    # files in git are never hardlinked
+    assert (bag_path / 'data' / '.datalad' / 'config').stat().st_nlink == 1
+    # a re-export must not write into the annex object
+    res = ds.x_export_bagit(bag_path, link_mode='copy')
+    assert (bag_path / 'data' / 'annexed').stat().st_ino \
+        != annex_object.stat().st_ino
+    assert annex_object.read_text() == 'annexed content'
+    # whatever the filesystem supports, the content ends up in the bag
+    res = ds.x_export_bagit(tmp_path / 'auto', link_mode='auto')
+    assert (tmp_path / 'auto' / 'data' / 'annexed').read_text() \
+        == 'annexed content'
+
+
+def test_export_bagit_key_digests(no_result_rendering, existing_dataset,
+                                  tmp_path):
+    ds = existing_dataset
+    (ds.pathobj / 'local.txt').write_text('local')
+    (ds.pathobj / 'remote.txt').write_text('remote')
+    ds.save(to_git=False)
+    remote_key = ds.repo.get_file_annexinfo('remote.txt')['key']
+    call_git_success(
+        ['annex', 'registerurl', remote_key, 'http://example.com/remote'],
+        cwd=ds.pathobj,
+        capture_output=True,
+    )
+    ds.x_export_bagit(tmp_path)
+    md5 = (tmp_path / 'manifest-md5.txt').read_text()
+    sha256 = (tmp_path / 'manifest-sha256.txt').read_text()
+    # digests of MD5E keys go into the MD5 manifest only
+    assert f'{hashlib.md5(b"local").hexdigest()}  data/local.txt' in md5
+    assert 'data/local.txt' not in sha256
+    # remote files are registered in the payload directory
+    assert 'http://example.com/remote\t6\tdata/remote.txt' \
+        in (tmp_path / 'fetch.txt').read_text()
+    assert 'data/remote.txt' in md5
+    # files in git are hashed with all configured algorithms
+    assert 'data/.datalad/config' in md5
+    assert 'data/.datalad/config' in sha256
+    assert 'Payload-Oxum: ' in (tmp_path / 'bag-info.txt').read_text()
+
+
+def test_export_bagit_no_merge(no_result_rendering, existing_dataset,
+                               tmp_path, monkeypatch):
+    ds = existing_dataset
+    (ds.pathobj / 'remote.txt').write_text('remote')
+    ds.save(to_git=False)
+    key = ds.repo.get_file_annexinfo('remote.txt')['key']
+    call_git_success(
+        ['annex', 'registerurl', key, 'http://example.com/remote'],
+        cwd=ds.pathobj,
+        capture_output=True,
+    )
+    merges = []
+    call_annex = type(ds.repo).call_annex
+
+    def failing_merge(self, args, *a, **kw):
+        if args == ['merge']:
+            merges.append(args)
+            raise CommandError('git annex merge', 'read-only')
+        return call_annex(self, args, *a, **kw)
+
+    monkeypatch.setattr(type(ds.repo), 'call_annex', failing_merge)
+    # a plan does not even try to merge
+    ds.x_export_bagit(tmp_path / 'bag', plan=True)
+    assert not merges
+    # a failing merge does not stop the export
+    ds.x_export_bagit(tmp_path / 'bag')
+    assert merges
+    assert 'http://example.com/remote' \
+        in (tmp_path / 'bag' / 'fetch.txt').read_text()
+
+
+def test_export_bagit_remote_only(no_result_rendering, existing_dataset,
+                                  tmp_path):
+    ds = existing_dataset
+    (ds.pathobj / 'remote.txt').write_text('remote')
+    ds.save(to_git=False)
+    (ds.pathobj / 'ingit.txt').write_text('ingit')
+    ds.save(to_git=True)
+    key = ds.repo.get_file_annexinfo('remote.txt')['key']
+    call_git_success(
+        ['annex', 'registerurl', key, 'http://example.com/remote'],
+        cwd=ds.pathobj,
+        capture_output=True,
+    )
+    ds.x_export_bagit(tmp_path / 'bag', remote_only=True)
+    assert not (tmp_path / 'bag' / 'data' / 'remote.txt').exists()
+    assert (tmp_path / 'bag' / 'data' / 'ingit.txt').read_text() == 'ingit'
+    assert 'http://example.com/remote\t6\tdata/remote.txt' \
+        in (tmp_path / 'bag' / 'fetch.txt').read_text()
+    # an annex'ed file without a URL cannot go into a holey bag
+    (ds.pathobj / 'local.txt').write_text('local')
+    ds.save(to_git=False)
+    res = ds.x_export_bagit(tmp_path / 'failed', remote_only=True,
+                            on_failure='ignore')
+    assert any(r['status'] == 'error' and 'local.txt' in r['message']
+               for r in res)
+    assert not (tmp_path / 'failed' / 'data' / 'local.txt').exists()
+
+
+def test_export_bagit_plan(no_result_rendering, existing_dataset, tmp_path,
+                           monkeypatch):
+    ds = existing_dataset
+    (ds.pathobj / 'local.txt').write_text('local')
+    (ds.pathobj / 'remote.txt').write_text('remote')
+    ds.save(to_git=False)
+    key = ds.repo.get_file_annexinfo('remote.txt')['key']
+    call_git_success(
+        ['annex', 'registerurl', key, 'http://example.com/remote'],
+        cwd=ds.pathobj,
+        capture_output=True,
+    )
+    res = ds.x_export_bagit(tmp_path / 'bag', plan=True)
+    assert not (tmp_path / 'bag').exists()
+    dsres = [r for r in res if r.get('type') == 'dataset']
+    assert len(dsres) == 1
+    assert dsres[0]['remote_files'] == 1
+    assert dsres[0]['remote_bytes'] == 6
+    assert dsres[0]['unavailable_files'] == 0
+    bagres = [r for r in res if r.get('type') == 'bag']
+    assert bagres[0]['status'] == 'ok'
+    # the prediction matches the actual export
+    ds.x_export_bagit(tmp_path / 'bag')
+    assert f'Payload-Oxum: {bagres[0]["payload_oxum"]}' \
+        in (tmp_path / 'bag' / 'bag-info.txt').read_text()
+
+    class _Usage:
+        free = 0
+
+    monkeypatch.setattr(_payload, 'disk_usage', lambda path: _Usage)
+    res = ds.x_export_bagit(tmp_path / 'other', plan=True,
+                            on_failure='ignore')
+    assert [r['status'] for r in res if r.get('type') == 'bag'] \
+        == ['impossible']
+
+
+def test_export_bagit_committed_tree(no_result_rendering, existing_dataset,
+                                     tmp_path):
+    ds = existing_dataset
+    (ds.pathobj / 'locked.txt').write_text('locked')
+    (ds.pathobj / 'unlocked.txt').write_text('unlocked')
+    (ds.pathobj / 'git.txt').write_text('git')
+    ds.save(path=['locked.txt', 'unlocked.txt'], to_git=False)
+    ds.save(path='git.txt', to_git=True)
+    ds.unlock('unlocked.txt')
+    ds.save()
+    ds.x_export_bagit(tmp_path / 'bag')
+    for name in ('locked', 'unlocked', 'git'):
+        assert (tmp_path / 'bag' / 'data' / f'{name}.txt').read_text() \
+            == name
+    # only a clean dataset is exported
+    (ds.pathobj / 'untracked.txt').write_text('untracked')
+    res = ds.x_export_bagit(tmp_path / 'dirty', on_failure='ignore')
+    assert any(r['status'] == 'error'
+               and r['message'] == 'Dataset has unsaved changes'
+               for r in res)
+
+
+def test_export_bagit_unknown_size(no_result_rendering, existing_dataset,
+                                   tmp_path):
+    ds = existing_dataset
+    # a key without a size, and without content
+    call_git_success(
+        ['annex', 'addurl', '--relaxed', 'http://example.com/nothing',
+         '--file', 'relaxed'],
+        cwd=ds.pathobj,
+        capture_output=True,
+    )
+    ds.save()
+    res = ds.x_export_bagit(tmp_path / 'bag', plan=True)
+    assert [r['unavailable_files'] for r in res
+            if r.get('type') == 'dataset'] == [1]
+    res = ds.x_export_bagit(tmp_path / 'bag', get_missing=True,
+                            on_failure='ignore')
+    assert [Path(r['path']).name for r in res
+            if r['status'] == 'impossible'] == ['relaxed']
+    assert (tmp_path / 'bag' / 'data' / '.datalad' / 'config').exists()
+
+
+def test_export_bagit_git_filters(no_result_rendering, existing_dataset,
+                                  tmp_path):
+    ds = existing_dataset
+    (ds.pathobj / '.gitattributes').write_text('*.txt text eol=crlf\n')
+    (ds.pathobj / 'lines.txt').write_text('one\ntwo\n')
+    ds.save(to_git=True)
+    # check out with the line endings the attributes ask for
+    (ds.pathobj / 'lines.txt').unlink()
+    call_git_success(['checkout', 'lines.txt'], cwd=ds.pathobj,
+                     capture_output=True)
+    ds.x_export_bagit(tmp_path / 'bag')
+    data = tmp_path / 'bag' / 'data'
+    # the worktree content went into the bag, and is accounted for
+    assert (data / 'lines.txt').read_bytes() == b'one\r\ntwo\r\n'
+    files = [p for p in data.rglob('*') if p.is_file()]
+    assert f'Payload-Oxum: {sum(p.stat().st_size for p in files)}.' \
+        f'{len(files)}' in (tmp_path / 'bag' / 'bag-info.txt').read_text()
+
+
+def test_export_bagit_revision(no_result_rendering, existing_dataset,
+                               tmp_path):
+    ds = existing_dataset
+    (ds.pathobj / 'annexed.txt').write_text('annexed v1')
+    (ds.pathobj / 'git.txt').write_text('git v1')
+    ds.save(path='annexed.txt', to_git=False)
+    ds.save(path='git.txt', to_git=True)
+    ds.repo.tag('v1')
+    ds.unlock('annexed.txt')
+    (ds.pathobj / 'annexed.txt').write_text('annexed v2')
+    (ds.pathobj / 'git.txt').write_text('git v2')
+    ds.save()
+    # the worktree is not consulted
+    (ds.pathobj / 'git.txt').write_text('dirty')
+    ds.x_export_bagit(tmp_path / 'bag', revision='v1')
+    assert (tmp_path / 'bag' / 'data' / 'annexed.txt').read_text() \
+        == 'annexed v1'
+    assert (tmp_path / 'bag' / 'data' / 'git.txt').read_text() == 'git v1'
+    assert f'{hashlib.md5(b"git v1").hexdigest()}  data/git.txt' \
+        in (tmp_path / 'bag' / 'manifest-md5.txt').read_text()
+    assert ds.repo.get_hexsha('v1') \
+        in (tmp_path / 'bag' / 'bag-info.txt').read_text()
+    ds.x_export_bagit(tmp_path / 'stream', archive='tar', stream=True,
+                      revision='v1')
+    with tarfile.open(tmp_path / 'stream.tar') as tar:
+        assert tar.extractfile('stream/data/git.txt').read() == b'git v1'
+        assert tar.extractfile('stream/data/annexed.txt').read() \
+            == b'annexed v1'
+    res = ds.x_export_bagit(tmp_path / 'bogus', revision='bogus',
+                            on_failure='ignore')
+    assert any(r['status'] == 'error' for r in res)
+
+
+def test_export_bagit_blob_reader(existing_dataset):
+    ds = existing_dataset
+    sha = ds.repo.call_git(['rev-parse', 'HEAD:.datalad/config']).strip()
+    content = (ds.pathobj / '.datalad' / 'config').read_bytes()
+    with _git._GitBlobReader(ds.repo) as reader:
+        assert reader.read(sha) == content
+        assert reader.read('HEAD:nothing') is None
+        with reader.open(sha) as (size, f):
+            assert f.read(3) == content[:3]
+        assert reader.read(sha) == content
+        # after a failure, the process is gone
+        with pytest.raises(RuntimeError):
+            with reader.open(sha) as (size, f):
+                raise RuntimeError('failed')
+        with pytest.raises(ValueError):
+            reader.read(sha)
+
+
+def test_export_bagit_join_annex_records():
+    tree = [('100644', 'sha', 1, p) for p in ('a b', 'a-b', 'a/b', 'z')]
+    records = [{'file': p} for p in ('a b', 'a/b')]
+    assert [(item[3], item[4]) for item in _git._join_annex_records(
+        tree, iter(records))] == [
+        ('a b', {'file': 'a b'}),
+        ('a-b', None),
+        ('a/b', {'file': 'a/b'}),
+        ('z', None),
+    ]
+
+
+def test_export_bagit_web_log_urls(no_result_rendering, existing_dataset,
+                                   tmp_path):
+    ds = existing_dataset
+    (ds.pathobj / 'remote.txt').write_text('remote')
+    ds.save(to_git=False)
+    key = ds.repo.get_file_annexinfo('remote.txt')['key']
+    for cmd, url in (('registerurl', 'http://example.com/gone'),
+                     ('registerurl', 'http://example.com/remote'),
+                     ('unregisterurl', 'http://example.com/gone')):
+        call_git_success(
+            ['annex', cmd, key, url],
+            cwd=ds.pathobj,
+            capture_output=True,
+        )
+    ds.x_export_bagit(tmp_path / 'bag')
+    assert (tmp_path / 'bag' / 'fetch.txt').read_text() \
+        == 'http://example.com/remote\t6\tdata/remote.txt\n'
+    # URLs are cached, and the cache follows changes of the annex branch
+    assert (ds.repo.dot_git / 'datalad'
+            / _annex._key_url_cache_name).exists()
+    call_git_success(
+        ['annex', 'unregisterurl', key, 'http://example.com/remote'],
+        cwd=ds.pathobj,
+        capture_output=True,
+    )
+    ds.x_export_bagit(tmp_path / 'local')
+    assert not (tmp_path / 'local' / 'fetch.txt').exists()
+    assert (tmp_path / 'local' / 'data' / 'remote.txt').read_text() \
+        == 'remote'
+    # a removed URL is not reported, the most recent present one is
+    assert _annex._get_web_log_url(
+        b'3s 1 http://example.com/a\n'
+        b'1s 1 http://example.com/b\n'
+        b'2s 0 http://example.com/a\n'
+        b'4s 0 http://example.com/c\n'
+    ) == 'http://example.com/a'
+    assert _annex._get_web_log_url(
+        b'1s 1 http://example.com/a\n'
+        b'2s 0 http://example.com/a\n'
+    ) is None
+
+
+def test_export_bagit_hash_while_copy(no_result_rendering, existing_dataset,
+                                      tmp_path, monkeypatch):
+    ds = existing_dataset
+    calls = []
+    orig_hash_file = _files._hash_file
+
+    def _hash_file(path, algorithms, copy_to=None):
+        calls.append((path, copy_to))
+        return orig_hash_file(path, algorithms, copy_to=copy_to)
+
+    monkeypatch.setattr(_files, '_hash_file', _hash_file)
+    ds.x_export_bagit(tmp_path)
+    # git-tracked files were read exactly once, while being copied
+    assert calls
+    assert all(copy_to is not None for path, copy_to in calls)
+    assert len(set(path for path, copy_to in calls)) == len(calls)
+    sha256 = (tmp_path / 'manifest-sha256.txt').read_text()
+    config = (ds.pathobj / '.datalad' / 'config').read_bytes()
+    assert f'{hashlib.sha256(config).hexdigest()}  data/.datalad/config' \
+        in sha256
+
+
+def test_export_bagit_hash_linked(no_result_rendering, existing_dataset,
+                                  tmp_path):
+    ds = existing_dataset
+    for i in range(3):
+        (ds.pathobj / f'worm{i}.txt').write_text(f'worm{i}')
+    # keys without a checksum
+    ds.repo.call_annex(['add', '--backend=WORM', '.'])
+    ds.save()
+    res = ds.x_export_bagit(tmp_path, link_mode='hardlink', jobs=2)
+    assert sum(r.get('message') == 'hardlinked into bag' for r in res) == 3
+    # linked files without a key digest got hashed with all algorithms
+    md5 = (tmp_path / 'manifest-md5.txt').read_text()
+    sha256 = (tmp_path / 'manifest-sha256.txt').read_text()
+    for i in range(3):
+        content = f'worm{i}'.encode()
+        assert f'{hashlib.md5(content).hexdigest()}  data/worm{i}.txt' \
+            in md5
+        assert f'{hashlib.sha256(content).hexdigest()}  data/worm{i}.txt' \
+            in sha256
+
+
+def test_export_bagit_update(no_result_rendering, existing_dataset, tmp_path):
+    ds = existing_dataset
+    bag_path = tmp_path / 'bag'
+    for name in ('keep', 'modify', 'remove'):
+        (ds.pathobj / 'dir' / name).parent.mkdir(exist_ok=True)
+        (ds.pathobj / 'dir' / name).write_text(name)
+    ds.save(to_git=False)
+    # an update of a non-existing bag is a plain export
+    ds.x_export_bagit(bag_path, update=True)
+    commit = ds.repo.get_hexsha()
+    assert f'DataLad-Export-Commit: {commit} .' \
+        in (bag_path / 'bag-info.txt').read_text()
+    # nothing changed, nothing to do
+    res = ds.x_export_bagit(bag_path, update=True)
+    assert [r['status'] for r in res] == ['notneeded']
+
+    (ds.pathobj / 'dir' / 'modify').unlink()
+    (ds.pathobj / 'dir' / 'modify').write_text('modified')
+    (ds.pathobj / 'dir' / 'remove').unlink()
+    (ds.pathobj / 'add').write_text('add')
+    ds.save(to_git=False)
+    res = ds.x_export_bagit(bag_path, update=True)
+    # only changed files were processed
+    assert sorted(Path(r['path']).name for r in res
+                  if r.get('type') == 'file') == ['add', 'modify']
+    assert (bag_path / 'data' / 'dir' / 'modify').read_text() == 'modified'
+    assert not (bag_path / 'data' / 'dir' / 'remove').exists()
+    md5 = (bag_path / 'manifest-md5.txt').read_text()
+    assert 'data/dir/keep' in md5
+    assert 'data/dir/remove' not in md5
+    assert f'{hashlib.md5(b"modified").hexdigest()}  data/dir/modify' in md5
+    assert f'{hashlib.md5(b"add").hexdigest()}  data/add' in md5
+    info = (bag_path / 'bag-info.txt').read_text()
+    assert f'DataLad-Export-Commit: {ds.repo.get_hexsha()} .' in info
+    # the updated bag is identical to a fresh export
+    ds.x_export_bagit(tmp_path / 'fresh')
+    for manifest in ('manifest-md5.txt', 'manifest-sha256.txt'):
+        assert (bag_path / manifest).read_text() \
+            == (tmp_path / 'fresh' / manifest).read_text()
+    oxum = [line for line in info.splitlines()
+            if line.startswith('Payload-Oxum')]
+    assert oxum[0] in (tmp_path / 'fresh' / 'bag-info.txt').read_text()
+
+
+def test_export_bagit_update_queries(no_result_rendering, existing_dataset,
+                                    tmp_path, monkeypatch):
+    ds = existing_dataset
+    bag_path = tmp_path / 'bag'
+    for name in ('keep', 'one', 'two'):
+        (ds.pathobj / name).write_text(name)
+    ds.save(to_git=False)
+    ds.x_export_bagit(bag_path)
+    for name in ('one', 'two'):
+        (ds.pathobj / name).unlink()
+        (ds.pathobj / name).write_text(f'{name} changed')
+    ds.save(to_git=False)
+    pathspecs = []
+    iter_tree = _payload._iter_tree
+
+    def _iter_tree(repo, treeish, pathspec=None):
+        pathspecs.append(pathspec)
+        return iter_tree(repo, treeish, pathspec)
+
+    monkeypatch.setattr(_payload, '_iter_tree', _iter_tree)
+    monkeypatch.setattr(_payload, '_PATHS_BATCH_SIZE', 1)
+    ds.x_export_bagit(bag_path, update=True)
+    # only changed files are looked at, in batches
+    assert pathspecs == [['one'], ['two']]
+    assert (bag_path / 'data' / 'two').read_text() == 'two changed'
+    assert f'{hashlib.md5(b"one changed").hexdigest()}  data/one' \
+        in (bag_path / 'manifest-md5.txt').read_text()
+
+
+def test_export_bagit_update_unknown_commit(no_result_rendering,
+                                            existing_dataset, tmp_path):
+    ds = existing_dataset
+    bag_path = tmp_path / 'bag'
+    for name in ('a.txt', 'gone.txt'):
+        (ds.pathobj / name).write_text(name)
+    ds.save(to_git=False)
+    ds.x_export_bagit(bag_path)
+    # the exported commit is not known to the dataset (anymore)
+    info = bag_path / 'bag-info.txt'
+    info.write_text(info.read_text().replace(ds.repo.get_hexsha(), '0' * 40))
+    (ds.pathobj / 'gone.txt').unlink()
+    (ds.pathobj / 'b.txt').write_text('b.txt')
+    ds.save(to_git=False)
+    ds.x_export_bagit(bag_path, update=True)
+    md5 = (bag_path / 'manifest-md5.txt').read_text()
+    assert 'data/a.txt' in md5
+    assert 'data/b.txt' in md5
+    assert 'data/gone.txt' not in md5
+    assert f'DataLad-Export-Commit: {ds.repo.get_hexsha()} .' \
+        in info.read_text()
+    res = ds.x_export_bagit(bag_path, update=True)
+    assert [r['status'] for r in res] == ['notneeded']
+
+
+def test_export_bagit_reexport(no_result_rendering, existing_dataset,
+                               tmp_path):
+    ds = existing_dataset
+    bag_path = tmp_path / 'bag'
+    for name in ('keep', 'dir/remove'):
+        (ds.pathobj / name).parent.mkdir(exist_ok=True)
+        (ds.pathobj / name).write_text(name)
+    ds.save(to_git=False)
+    ds.x_export_bagit(bag_path)
+    (ds.pathobj / 'dir' / 'remove').unlink()
+    ds.save()
+    # without an update, the bag is exported anew
+    ds.x_export_bagit(bag_path)
+    assert (bag_path / 'data' / 'keep').read_text() == 'keep'
+    assert not (bag_path / 'data' / 'dir').exists()
+    assert 'data/dir/remove' \
+        not in (bag_path / 'manifest-md5.txt').read_text()
+    # a file that was not placed into the bag by an export is kept
+    (bag_path / 'data' / 'mine').write_text('mine')
+    ds.x_export_bagit(bag_path)
+    assert 'data/mine' in (bag_path / 'manifest-md5.txt').read_text()
+    # a directory with other content is not turned into a bag
+    (tmp_path / 'other').mkdir()
+    (tmp_path / 'other' / 'precious.doc').write_text('precious')
+    res = ds.x_export_bagit(tmp_path / 'other', on_failure='ignore')
+    assert [r['status'] for r in res] == ['impossible']
+    assert (tmp_path / 'other' / 'precious.doc').read_text() == 'precious'
+
+
+def test_export_bagit_stream(no_result_rendering, existing_dataset, tmp_path,
+                             capfdbinary):
+    ds = existing_dataset
+    (ds.pathobj / 'annexed').write_text('annexed')
+    (ds.pathobj / 'remote').write_text('remote')
+    ds.save(to_git=False)
+    call_git_success(
+        ['annex', 'registerurl',
+         ds.repo.get_file_annexinfo('remote')['key'],
+         'http://example.com/remote'],
+        cwd=ds.pathobj,
+        capture_output=True,
+    )
+    ds.x_export_bagit(tmp_path / 'dir')
+    res = ds.x_export_bagit(tmp_path / 'bag', archive='tgz', stream=True)
+    # no bag directory was created
+    assert not (tmp_path / 'bag').exists()
+    assert res[-1]['path'] == str(tmp_path / 'bag.tgz')
+    with tarfile.open(tmp_path / 'bag.tgz') as tar:
+        assert tar.getnames()[0] == 'bag/bagit.txt'
+        assert tar.extractfile('bag/data/annexed').read() == b'annexed'
+        for name in ('manifest-md5.txt', 'manifest-sha256.txt', 'fetch.txt'):
+            assert tar.extractfile(f'bag/{name}').read() \
+                == (tmp_path / 'dir' / name).read_bytes()
+        tar.extractall(tmp_path / 'extracted')
+    # the bag is valid, apart from the remote file that is not fetched
+    from bdbag.bdbagit import BDBag
+    (tmp_path / 'extracted' / 'bag' / 'data' / 'remote').write_text('remote')
+    BDBag(str(tmp_path / 'extracted' / 'bag')).validate()
+
+    # stream to stdout
+    capfdbinary.readouterr()
+    ds.x_export_bagit('-', archive='zip')
+    with zipfile.ZipFile(BytesIO(capfdbinary.readouterr().out)) as zf:
+        assert zf.read(f'{ds.pathobj.name}/data/annexed') == b'annexed'
+        assert zf.read(f'{ds.pathobj.name}/manifest-md5.txt') \
+            == (tmp_path / 'dir' / 'manifest-md5.txt').read_bytes()
+
+
+def test_export_bagit_stream_unavailable(no_result_rendering,
+                                         existing_dataset, tmp_path,
+                                         monkeypatch):
+    ds = existing_dataset
+    for name in ('present', 'absent'):
+        (ds.pathobj / name).write_text(name)
+    ds.save(to_git=False)
+    cl = clone(source=ds.path, path=tmp_path / 'clone')
+    cl.get('present')
+    res = cl.x_export_bagit(tmp_path / 'bag', archive='tar', stream=True,
+                            on_failure='ignore')
+    assert [Path(r['path']).name for r in res
+            if r['status'] == 'impossible'] == ['absent']
+    with tarfile.open(tmp_path / 'bag.tar') as tar:
+        assert tar.extractfile('bag/data/present').read() == b'present'
+        assert 'bag/data/absent' not in tar.getnames()
+        assert 'data/absent' \
+            not in tar.extractfile('bag/manifest-md5.txt').read().decode()
+
+    # an incomplete archive is not left behind
+    def add_file(*args, **kwargs):
+        raise OSError('failed')
+
+    monkeypatch.setattr(_stream._TarStream, 'add_file', add_file)
+    with pytest.raises(OSError):
+        cl.x_export_bagit(tmp_path / 'failed', archive='tar', stream=True)
+    assert not (tmp_path / 'failed.tar').exists()
+
+
+def test_export_bagit_resume(no_result_rendering, existing_dataset, tmp_path,
+                             monkeypatch):
+    ds = existing_dataset
+    for name in ('one', 'two'):
+        (ds.pathobj / name).write_text(name)
+    ds.save(to_git=False)
+    journal = tmp_path / 'bag' / _journal._journal_name
+
+    def _save_bag(*args, **kwargs):
+        raise RuntimeError('interrupted')
+
+    with monkeypatch.context() as m:
+        m.setattr(_directory, '_save_bag', _save_bag)
+        with pytest.raises(RuntimeError):
+            ds.x_export_bagit(tmp_path / 'bag')
+    assert journal.exists()
+    # a file that changed since is placed into the bag again
+    (tmp_path / 'bag' / 'data' / 'two').unlink()
+    (tmp_path / 'bag' / 'data' / 'two').write_text('owt')
+    res = ds.x_export_bagit(tmp_path / 'bag', resume=True)
+    assert {Path(r['path']).name for r in res
+            if r.get('type') == 'file' and r['status'] == 'notneeded'} \
+        == {'one', 'config', '.gitattributes'}
+    assert (tmp_path / 'bag' / 'data' / 'two').read_text() == 'two'
+    assert not journal.exists()
+    assert hashlib.md5(b'one').hexdigest() \
+        in (tmp_path / 'bag' / 'manifest-md5.txt').read_text()
+
+
+def test_export_bagit_selection(no_result_rendering, existing_dataset,
+                                tmp_path):
+    ds = existing_dataset
+    for name, size in (('results/big.csv', 100), ('results/small.csv', 1),
+                       ('results/big.txt', 100), ('other/big.csv', 100)):
+        (ds.pathobj / name).parent.mkdir(exist_ok=True)
+        (ds.pathobj / name).write_text('x' * size)
+    ds.save(to_git=False)
+    for name in ('sub1', 'sub2'):
+        sub = ds.create(name)
+        (sub.pathobj / 'file.csv').write_text(name)
+        sub.save()
+    ds.save(recursive=True)
+    res = ds.x_export_bagit(tmp_path / 'bag', path=['results', 'sub1'],
+                            recursive=True)
+    assert {r['path'] for r in res if r.get('type') == 'dataset'} \
+        == {ds.path, str(ds.pathobj / 'sub1')}
+    md5 = (tmp_path / 'bag' / 'manifest-md5.txt').read_text()
+    for name in ('results/big.csv', 'results/small.csv', 'results/big.txt',
+                 'sub1/file.csv', 'sub1/.datalad/config'):
+        assert f'data/{name}' in md5
+    assert 'data/other' not in md5
+    assert 'data/.datalad' not in md5
+    # annex matching options only select annex'ed files
+    ds.x_export_bagit(tmp_path / 'matched', path='results',
+                      annex_match='--include=*.csv --largerthan=10')
+    assert (tmp_path / 'matched' / 'manifest-md5.txt').read_text() \
+        .split()[1::2] == ['data/results/big.csv']
+
+
+def test_export_bagit_dedup(no_result_rendering, existing_dataset, tmp_path):
+    ds = existing_dataset
+    for name in ('one', 'two', 'dir/three'):
+        (ds.pathobj / name).parent.mkdir(exist_ok=True)
+        (ds.pathobj / name).write_text('same')
+    sub = ds.create('sub')
+    (sub.pathobj / 'four').write_text('same')
+    sub.save(to_git=False)
+    ds.save(recursive=True, to_git=False)
+    res = ds.x_export_bagit(tmp_path / 'bag', recursive=True, archive='tar')
+    data = tmp_path / 'bag' / 'data'
+    # one copy, all other files are hardlinks to it
+    assert len({(data / name).stat().st_ino
+                for name in ('one', 'two', 'dir/three', 'sub/four')}) == 1
+    assert len([r for r in res if r.get('message')
+                == 'hardlinked from identical file in bag']) == 3
+    md5 = (tmp_path / 'bag' / 'manifest-md5.txt').read_text()
+    assert md5.count(hashlib.md5(b'same').hexdigest()) == 4
+    # hardlinks are kept in archives
+    for archive, kwargs in (('bag.tar', {}),
+                            ('streamed.tar', dict(stream=True))):
+        if kwargs:
+            ds.x_export_bagit(tmp_path / 'streamed', recursive=True,
+                              archive='tar', **kwargs)
+        with tarfile.open(tmp_path / archive) as tar:
+            members = [m for m in tar.getmembers()
+                       if m.name.endswith(('one', 'two', 'three', 'four'))]
+        assert len(members) == 4
+        assert len([m for m in members if m.islnk()]) == 3
+
+
+def test_export_bagit_object_store(no_result_rendering, existing_dataset,
+                                   tmp_path):
+    ds = existing_dataset
+    for name in ('one', 'two'):
+        (ds.pathobj / name).write_text(name)
+    ds.save(to_git=False)
+    store = tmp_path / 'store'
+    res = ds.x_export_bagit(tmp_path / 'bag1', object_store=store)
+    objects = [p for p in store.rglob('*')
+               if p.is_file() and '.used' not in p.parts]
+    assert len(objects) == 2
+    # the content in the store is not shared with the dataset
+    annexed = {(ds.pathobj / name).stat().st_ino for name in ('one', 'two')}
+    assert not annexed & {p.stat().st_ino for p in objects}
+    # by default, content is linked into the bag from the store
+    assert {r['message'] for r in res
+            if Path(r['path']).name in ('one', 'two')} \
+        <= {'hardlinked into bag', 'reflinked into bag'}
+    mtimes = {p: p.stat().st_mtime_ns for p in objects}
+    # a clone without any content can be exported from the store
+    cl = clone(source=ds.path, path=tmp_path / 'clone')
+    res = cl.x_export_bagit(tmp_path / 'bag2', object_store=store,
+                            link_mode='copy')
+    for name in ('one', 'two'):
+        assert (tmp_path / 'bag2' / 'data' / name).read_text() == name
+    # and is copied from there, if requested
+    assert {r['message'] for r in res
+            if Path(r['path']).name in ('one', 'two')} == {'copied into bag'}
+    assert not {p.stat().st_ino for p in objects} & {
+        (tmp_path / 'bag2' / 'data' / name).stat().st_ino
+        for name in ('one', 'two')}
+    # without changing files that could be shared with bags
+    assert {p: p.stat().st_mtime_ns for p in objects} == mtimes
+    # least recently used content is removed beyond the size limit
+    (ds.pathobj / 'three').write_text('three')
+    ds.save(to_git=False)
+    ds.x_export_bagit(tmp_path / 'bag3', path='three', object_store=store,
+                      object_store_size=5)
+    assert [p.name for p in store.rglob('*')
+            if p.is_file() and '.used' not in p.parts] \
+        == [ds.repo.get_file_annexinfo('three')['key']]
+    assert (tmp_path / 'bag1' / 'data' / 'one').read_text() == 'one'
+
+
+def test_export_bagit_versions(no_result_rendering, existing_dataset,
+                               tmp_path):
+    ds = existing_dataset
+    for name in ('same.txt', 'changed.txt'):
+        (ds.pathobj / name).write_text(f'{name} v1')
+    ds.save(to_git=False)
+    (ds.pathobj / 'git.txt').write_text('git')
+    ds.save(to_git=True)
+    ds.repo.tag('v1')
+    (ds.pathobj / 'changed.txt').unlink()
+    (ds.pathobj / 'changed.txt').write_text('changed.txt v2')
+    ds.save(to_git=False)
+    ds.repo.tag('v2')
+    res = ds.x_export_bagit(tmp_path / 'bags', revision=['v1', 'v2'])
+    v1 = tmp_path / 'bags' / 'v1'
+    v2 = tmp_path / 'bags' / 'v2'
+    for version in ('v1', 'v2'):
+        assert (tmp_path / 'bags' / version / 'data' / 'changed.txt') \
+            .read_text() == f'changed.txt {version}'
+        assert ds.repo.get_hexsha(version) \
+            in (tmp_path / 'bags' / version / 'bag-info.txt').read_text()
+    # files with identical content are shared between the bags
+    for name in ('same.txt', 'git.txt', '.datalad/config'):
+        assert (v1 / 'data' / name).stat().st_ino \
+            == (v2 / 'data' / name).stat().st_ino
+    assert (v1 / 'data' / 'changed.txt').stat().st_ino \
+        != (v2 / 'data' / 'changed.txt').stat().st_ino
+    assert {Path(r['path']).name for r in res
+            if r.get('message') == 'hardlinked from bag of another version'} \
+        >= {'same.txt', 'git.txt', 'config'}
+    sha256 = (v2 / 'manifest-sha256.txt').read_text()
+    assert f'{hashlib.sha256(b"git").hexdigest()}  data/git.txt' in sha256
+    # revisions that would share a bag directory are refused
+    ds.repo.tag('release/1')
+    ds.repo.tag('release_1')
+    res = ds.x_export_bagit(tmp_path / 'clash',
+                            revision=['release/1', 'release_1'],
+                            on_failure='ignore')
+    assert [r['status'] for r in res] == ['impossible']
+    assert not (tmp_path / 'clash').exists()